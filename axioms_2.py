@@ -5,23 +5,69 @@
 # This is for the purposes of automating symbolic math operations that 
 # undergraduates and professional engineers frequent
 import numpy as np
+import sys
+import threading
+import time
+import weakref
+import re
+import struct
+from collections import namedtuple, OrderedDict
+from array import array
 
 
 class expr:
-    def __init__(self,exp:str=None,root=None,**kwargs):
+    def __init__(self,exp:str=None,root=None,fold:bool=False,**kwargs):
         # str expressions and roots of trees to define expression objects
+        # With fold=True subtrees without variables are replaced by their values, see fold_constants
         self.root = root
 
         if isinstance(exp,str):
             self.root = self.exp2tree(exp)
+
+        self._printed = None        # (folded root, root it was folded from), str prints the root it was folded from
+        if fold:
+            self._printed = (fold_constants(self.root),self.root)
+            self.root = self._printed[0]
         
-        self.dir = {}
-        self.map()
+        self._compiled = None       # function generated by compile() for the current root
+        self._compiled_array = None # function generated by compile(array=True) for the current root
+        self._evals = 0             # evaluations of the current root, used to decide when to compile
+        self._derivatives = {}      # var -> roots of the derivatives of the current root, see derivatives()
+        self._paths = None          # var -> int encoded paths of the variables of _paths_root, see _var_paths
+        self._paths_root = None
+        self._dir = None            # _paths decoded into lists, see dir
+
+    def _index(self):
+        # Returns the int encoded paths of the variables of the current root
+        # The index is built the first time it is needed for a root
+        if self._paths_root is not self.root:
+            self._paths = _var_paths(self.root)
+            self._paths_root = self.root
+            self._dir = None
+        return self._paths
+
+    @property
+    def dir(self):
+        # dict of 'variable' and [path] pairs, a path is a list of 1/0 for going left/right from root to the variable
+        paths = self._index()
+        if self._dir==None:
+            self._dir = {var:[_decode_path(path) for path in var_paths] for var,var_paths in paths.items()}
+        return self._dir
 
     def exp2tree(self,exp):
         # Converts the raw string into a tree
         # ex. list2tree('a+b')=> node(val='+', left=node('a'), right=node('b'))
+        # Strings that have been parsed before return the root saved in parse_cache
+        key = exp.replace(' ','')
+        root = parse_cache.get(key)
+        if root is None:
+            root = self._parse(exp)
+            parse_cache.put(key,root)
+        return root
 
+    def _parse(self,exp):
+        # Parses the raw string without looking it up in parse_cache
+        
         # check for mismatched delimiters
         if exp.count('(')!= exp.count(')'):
             raise Exception('Mismatched delimiters')
@@ -29,16 +75,13 @@ class expr:
         if '-^' in exp:
             raise Exception('Cannot determine precendence of operators')
         
-        exp = exp.replace(' ','')       # Remove blank space
-
         # Need to check for incomplete expressions / errors in expressions
 
         # tokenizes the string expression into a list
         exp_list = _tokenize(exp)
-        protected_string = ['(',')','==','=','<','>','<=','>=','+','-','*','/','^','&','|',',']
 
         # replaces recognized data with constants and throws errors for strings that cannot be interpreted
-        exp_list = [val if val in protected_string else self._str2values(val) for val in exp_list]  
+        exp_list = [t if t.kind=='operator' else t._replace(val=self._str2values(t.val)) for t in exp_list]
         
         return self.list2tree(exp_list) # returns thee root of a tree generated from the exp list
 
@@ -78,86 +121,87 @@ class expr:
         raise Exception(f'{s}: is not recognized as a valid value or function')
 
     def list2tree(self,op_list:list):
-        # Converts a tokenized expression to a tree
-        # list2tree(['a','+','b'])=> node(val='+', left=node('a'), right=node('b'))
-        # Handles parhentesis
-
-        single_arg_operators = [
-            'sin',
-            'cos',
-            'tan',
-            'csc',
-            'sec',
-            'cot',
-            'asin',
-            'acos',
-            'atan',
-            '!',
-            'exp',
-            'ln']
-        
-        # Compress parhentesis protected expressions into sublists(sub expressions) within the full expression
-        while '(' in op_list:
-            op_list = self.compress_parhentesis(op_list)
-        
-        # expressions of length 1 are either variables, vals or a list element with a sub expression
-        if len(op_list)==1:
-            # variable or vals
-            if type(op_list[0])in [str,bool, int, float, complex]:
-                return node(op_list[0])
-            # sub expressions
-            elif type(op_list[0])==list:
-                return self.list2tree(op_list[0])
-        
-        # expressions of length 2 are either a recognized single arg function or arbitrary function
-        if len(op_list)==2:
-            # negative operator is a special case that may occur
-            if op_list[0]=='-':
-                return node('*',node(-1),self.list2tree(op_list[1]))
-
-            elif op_list[0] in single_arg_operators: # Recognized single argument expressions
-                # returns op_list[0] operates on the expression or val of op_list[1]
-                return node(op_list[0],right=self.list2tree(op_list[1]))
-            
-            # arbitrary function case
-            elif isinstance(op_list[0],str) and isinstance(op_list[1],list):
-                temp = ''.join(map(str,op_list[1][0]))      # recombines the list into a string
-                temp = temp.split(',')                      # splits the string arguments seperated by commas
-                return node(op_list[0],right = node(temp))  # returns a node of arbitrary operator operating on a node with val= to a list of arguments
-        
-        # special case of multiple operations led by a '-'
-        # replaces -a... with -1*a...
-        if op_list[0]=='-':
-            op_list[0:2] = [[-1,'*',op_list[1]]] 
-
-        # Determines the next operator which will operate left and right components
-        n_op = next_operator(op_list)
-
-        val = op_list[n_op]
-        left = self.list2tree(op_list[:n_op])      # Splicing and recursion to assign left and right pointers
-        right = self.list2tree(op_list[n_op+1:])   
-
-        return node(val,left,right)
-
-    
-    def compress_parhentesis(self,exp_list):
-        # algorithm that searches for the closing parhentesis of the first '('
-        p1 = exp_list.index('(')   # left outermost parhentesis
-        depth = 1
-        for i,c in enumerate(exp_list[p1+1:]):
-            if c=='(':
-                depth+=1
-            elif c==')':
-                depth-=1
-            
-            if depth==0:
-                break
+        # Converts a list of tokens to a tree in a single pass over the tokens (shunting-yard)
+        # list2tree(_tokenize('a+b'))=> node(val='+', left=node('a'), right=node('b'))
+        # Handles parhentesis, '-a'=> -1*a, single argument functions and arbitrary functions f(a,b)
+
+        # An operator is applied to the values to its left and right once an operator of lower precedence
+        # (_precedence) follows it. Operators of equal precedence apply from the left except '^' which
+        # applies from the right. '-' and single argument functions in front of a value bind to that value only.
+        prefix = len(_precedence)   # precedence of '-a' and sin(a), above every binary operator
+        operands = []               # sub trees that have been built
+        operators = []              # (precedence, operator, is prefix) waiting for their right value, None for '('
+
+        def apply():
+            # pops the top operator and replaces its values on the operand stack with the operation
+            _,op,is_prefix = operators.pop()
+            right = operands.pop()
+            if is_prefix:
+                operands.append(node('*',node(-1),right) if op=='-' else node(op,right=right))
+            else:
+                operands.append(node(op,operands.pop(),right))
+
+        def starts_value(k):
+            # whether the token at index k begins a value
+            return k<len(op_list) and (op_list[k].kind!='operator' or op_list[k].val=='(')
+
+        expect_value = True # whether the next token starts a value or is an operator
+        i = 0
+        while i<len(op_list):
+            kind,val,start = op_list[i]
+            if expect_value:
+                following = op_list[i+1] if i+1<len(op_list) else None
+                if val=='(' and kind=='operator':
+                    operators.append(None)
+                elif val=='-' and kind=='operator':
+                    operators.append((prefix,'-',True))
+                elif kind=='operator':
+                    raise Exception(f'{val}: is missing a left value (position {start})')
+                elif val in _single_arg_operators and starts_value(i+1):
+                    # a single argument operator applies to the value that follows it, the scanner keeps
+                    # names such as 'lnsin' as one token so they are arbitrary functions and not ln(sin(x))
+                    operators.append((prefix,val,True))
+                elif kind=='name' and following is not None and following.kind=='operator' and following.val=='(':
+                    # arbitrary function, the arguments are saved as strings seperated by commas
+                    depth = 0
+                    for j in range(i+1,len(op_list)):
+                        if op_list[j].kind=='operator':
+                            depth += (op_list[j].val=='(') - (op_list[j].val==')')
+                        if depth==0:
+                            break
+                    else:
+                        raise Exception('Mismatched delimiters')
+                    args = ''.join(str(t.val) for t in op_list[i+2:j]).split(',')
+                    operands.append(node(val,right=node(args)))
+                    expect_value = False
+                    i = j
+                else:
+                    operands.append(node(val))
+                    expect_value = False
+            elif val==')' and kind=='operator':
+                while operators and operators[-1] is not None:
+                    apply()
+                if not operators:
+                    raise Exception('Mismatched delimiters')
+                operators.pop()
+            elif kind!='number' and val in _precedence:
+                precedence = _precedence[val]
+                while operators and operators[-1] is not None and (operators[-1][0]>precedence or operators[-1][0]==precedence and val!='^'):
+                    apply()
+                operators.append((precedence,val,False))
+                expect_value = True
+            else:
+                raise Exception(f'{val}: is missing an operator (position {start})')
+            i+=1
+
+        if expect_value:
+            raise Exception('Incomplete expression')
+        while operators:
+            if operators[-1] is None:
+                raise Exception('Mismatched delimiters')
+            apply()
         
-        p2 = p1+i+1
-
-        # returns a list with the first and outermost parhentesis surpressed expression enclosed by a list
-        exp_list[p1:p2+1] = [[exp_list[p1+1:p2]]]   
-        return exp_list
+        return operands[0]
 
     def evaluate(self,root=None,val_dict:dict={}):
         # Evaluates an expression tree
@@ -165,96 +209,139 @@ class expr:
         # Else returns None
         # Assumes the expression to be valid ie. For expressions with logical statements or equivalencies
         # it is assumed the expressions are valid
+        # The whole tree is walked on its first evaluation, after that it is evaluated with compile()
 
         '''
         >>> a = expr('a+b')
         >>> a.evaluate(val_dict={'a':1,'b':2})
         3
+        >>> b = expr('10.0^400*z')     # the left side is not evaluated when z has no value
+        >>> b.evaluate(),b.evaluate()
+        (None, None)
         '''
 
         if root==None:
-            root =self.root
-        
-        if root!=None and isinstance(root.val,list): #arbitrary function case
+            if self._compiled is None or self._compiled.root is not self.root:
+                self._evals+=1
+                if self._evals<2:
+                    return self._evaluate_aux(self.root,val_dict)
+                self._compiled = self.compile()
+
+            f = self._compiled
+            return f(*[val_dict.get(var) for var in f.args])
+
+        return self._evaluate_aux(root,val_dict)
+
+    def cse_info(self):
+        # Returns how many operations an evaluation takes, see _cse_info
+        '''
+        >>> expr('sin(x)^2+sin(x)*cos(x)').cse_info()
+        {'operations': 6, 'evaluated': 5, 'saved': 1}
+        '''
+        return _cse_info([self.root])
+
+    @staticmethod
+    def _evaluate_aux(root,val_dict):
+        # Walks the tree without recursion to evaluate it
+        # values holds the values of evaluated subtrees so shared subtrees are only evaluated once
+        # The left side of an operation is only evaluated when the right side has a value
+        values = {}
+        stack = [root]
+        while stack:
+            a = stack[-1]
+            if a in values:
+                stack.pop()
+                continue
+
+            if a.right is not None and a.right not in values:
+                stack.append(a.right)
+                continue
+            right = values.get(a.right)
+            if a.left is not None and a.left not in values and (a.val=='=' or right is not None and a.val in _operators):
+                stack.append(a.left)
+                continue
+            stack.pop()
+            values[a] = expr._evaluate_node(a,val_dict,values)
+        return values[root]
+
+    @staticmethod
+    def _evaluate_node(root,val_dict,values):
+        # Value of root where the values of its subtrees are in values
+
+        if isinstance(root.val,list): #arbitrary function case
             return None
 
         # For when the root val type is in a value set return the raw value
-        if type(root.val) in [bool,int,float,float,complex]:
+        if type(root.val) in _value_types:
             return root.val
         
         elif isinstance(root.val,str) and root.right==None:# Identified variable type
-            val_dict['pi'] = np.pi
-            val_dict['e'] = np.e
-            val_dict['i'] = 1j
+            if root.val in _constants:
+                return _constants[root.val]
             if root.val in val_dict:
                 return val_dict[root.val]
             return None
 
-        operator = {    # Operators with 2 inputs
-            '+':lambda a,b: a+b,
-            '-':lambda a,b: a-b,
-            '/':lambda a,b: a/b if b!= 0 else None,
-            '*':lambda a,b: a*b,
-            '^':lambda a,b: a**b if (a and b)!=0 else None,
-            '&':lambda a,b: a&b,
-            '|':lambda a,b: a|b,
-            '%':lambda a,b: a%b,
-            '>':lambda a,b:a>b,
-            '<':lambda a,b:a<b,
-            '>=':lambda a,b:a>=b,   # need to recognize these operators within text
-            '<=':lambda a,b:a<=b,
-            '==': lambda a,b: a==b,
-            '=': 'Easter Egg'
-        }
-
-        single_operators={          # operators with single inputs
-            '!':lambda a:not a,
-            'cos':lambda a: np.cos(a),
-            'sin':lambda a: np.sin(a),
-            'tan':lambda a: np.tan(a),
-            'sec':lambda a: np.sec(a),
-            'csc': lambda a: np.csc(a),
-            'asin': lambda a: np.arcsin(a),
-            'acos': lambda a: np.arccos(a),
-            'atan':lambda a : np.arctan(a),
-            'ln': lambda a: np.log(a),
-            'exp': lambda a:np.exp(a)
-        }
+        if root.right==None:    # nodes without a right branch can't be operations
+            return None
 
         # Given that val is an operation, node.right != None
-
-
-        right = self.evaluate(root.right,val_dict=val_dict)
+        right = values[root.right]
         
         # Special case of evaluating '='
-
         if root.val=='=': # '=' operator requires a little more complication
-            left = self.evaluate(root.left, val_dict=val_dict)  # '=' has left node that can be evaluated
-
-            # If both sides can be evaluated check equivalence
-            if (left and right) in [bool,int,float,float,complex] and left!=right:
-                raise Exception('Invalid expression')
-            
-            # Return left or right if they are valued datatypes
-            elif type(left) in [bool,int,float,float,complex]:
-                return left
-            elif type(right) in [bool,int,float,float,complex]:
-                return right
-            
-            return None
+            left = values.get(root.left)  # '=' has left node that can be evaluated
+            return _assign(left,right)
 
         if right==None: # Right must be real valued for an expression to be evaluated
             return None
 
-        if root.val in single_operators:    # returns the respective value of the operation(value) for a single arg function
-            return single_operators[root.val](right)
-
-        left = self.evaluate(root.left, val_dict=val_dict)  # Evaluate left sub expression to evaluate 2 arg expression ie '+'
+        if root.val in _single_operators:    # returns the respective value of the operation(value) for a single arg function
+            return _single_operators[root.val](right)
 
-        if root.val in operator:
+        if root.val in _operators and root.left!=None:
+            left = values[root.left]  # Evaluate left sub expression to evaluate 2 arg expression ie '+'
             if left ==None:
                 return None
-            return operator[root.val](left,right)   # maps root.val to the lambda operation in operator dict
+            return _operators[root.val](left,right)   # maps root.val to the lambda operation in operator dict
+
+    def evaluate_array(self,val_dict:dict={}):
+        # Evaluates the expression elementwise where the values of val_dict may be numpy arrays
+        # Values are broadcast against each other and the result has the broadcast shape
+        # Results that evaluate() would return as None are NaN, comparisons and '&','|' are boolean masks
+        '''
+        >>> expr('x^2+1').evaluate_array(val_dict={'x':np.arange(1,4)})
+        array([ 2.,  5., 10.])
+        >>> expr('1/x').evaluate_array(val_dict={'x':np.arange(3)})
+        array([nan, 1. , 0.5])
+        '''
+        if self._compiled_array is None or self._compiled_array.root is not self.root:
+            self._compiled_array = self.compile(array=True)
+
+        f = self._compiled_array
+        result = f(*[np.asarray(val_dict[var]) if var in val_dict else np.nan for var in f.args])
+        shape = np.broadcast_shapes(*[np.shape(val) for val in val_dict.values()])
+        return np.array(np.broadcast_to(result,np.broadcast_shapes(np.shape(result),shape)))
+
+    def compile(self,args:list=None,array:bool=False):
+        # Lowers the tree once into a generated python function with one statement per node
+        # Variables are bound to positional argument slots in the order of args
+        # By default args are the sorted variables of the expression
+        # The returned function has .args, .root and .source attributes
+        # Missing arguments evaluate as None in the same way evaluate() treats missing variables
+        # With array=True the function operates elementwise on numpy arrays, see evaluate_array()
+        '''
+        >>> f = expr('a*x+b').compile()
+        >>> f.args
+        ('a', 'b', 'x')
+        >>> f(2,1,3)
+        7
+        >>> f(2,1)
+        '''
+        if args==None:
+            args = _variables(self.root)
+
+        return _compile_roots([self.root],args,array)
 
     def display(self,root=None):
         # Purely for debugging purposes
@@ -310,95 +397,298 @@ class expr:
         return lines, n + m + u, max(p, q) + 2, n + u // 2
 
     def estimate(self,var:str,precision:int=3):
+        # Numerical solution of the expression (f=g is solved as f-g=0) for var, see find_root
+        # Returns the root rounded to precision significant digits
         if precision>18:
             raise Exception('To many units of percision')
-        r = np.random.rand()
-        z = _copy(self.root)
-        if z.val=='=':
-            z = node('-',z.left,z.right)
-        z = expr(root=z)
-        dir = expr(root=z.root).pD(var)
-        temp = expr(root = node('/',z.root,dir.root))
-        for i in range(1000):
-            r-=temp.evaluate(val_dict={var:r})
-
-        d = dir.evaluate(val_dict={var:r})
-
-        upper = r if d>0 else r-2*self.evaluate(val_dict={var:r})/d
-        lower = r if d<0 else r-2*self.evaluate(val_dict={var:r})/d
-        a = np.abs(d)*10
-        a = 1/a
-
-        while f'{upper:.{precision}e}'!= f'{lower:.{precision}e}':
-            upper-=a*z.evaluate(val_dict={var:upper})*dir.evaluate(val_dict={var:upper})
-            lower-=a*z.evaluate(val_dict={var:lower})*dir.evaluate(val_dict={var:lower})
-
-        return float(f'{upper:.{precision-1}e}')
-    
-    def num_int(self,a,b,var,precision:int=3):
+        result = self.find_root(var,tol=10.0**-(precision+2))
+        if not result.converged:
+            raise Exception(f'Could not find a root for {var}: {result.message}')
+        return float(f'{result.root:.{precision-1}e}')
+
+    def find_root(self,var:str,bracket:tuple=None,x0:float=None,tol:float=1e-12,maxiter:int=100,val_dict:dict={}):
+        # Root of the expression (f=g is solved as f-g=0) in var by safeguarded Newton iteration
+        # The function and its derivative (from pD) are compiled into one function that returns both.
+        # With a bracket [a,b] where f(a) and f(b) differ in sign, Newton steps that leave the bracket or
+        # do not halve it are replaced by Illinois (regula falsi) steps and the bracket always shrinks.
+        # Without a bracket Newton starts from x0 (0.5 by default) and when it fails a bracket is searched
+        # for around x0. Other variables of the expression are given in val_dict
+        # Stops once a step is within tol*(1+|x|) or after maxiter iterations, returns a root_result
+        # A bracket around a pole (|f| at the end larger than at the ends of the bracket) does not converge
+        '''
+        >>> r = expr('x^2=2').find_root('x',bracket=(1,3))
+        >>> r.converged, round(r.root,12)
+        (True, 1.414213562373)
+        '''
+        f = _solver_function(self.root,var,val_dict)
+        result = root_result()
+
+        if bracket==None:
+            x = 0.5 if x0==None else x0
+            for result.iterations in range(1,maxiter+1):
+                fx,dfx = f(x)
+                result.evaluations+=1
+                if fx==None or not dfx:
+                    break
+                step = fx/dfx
+                x-=step
+                if abs(step)<=tol*(1+abs(x)):
+                    fx,_ = f(x)
+                    result.evaluations+=1
+                    if fx!=None:
+                        return result._done(x,fx,True,'newton converged')
+                    break
+            bracket = _search_bracket(self.root,var,0.5 if x0==None else x0,val_dict)
+            if bracket==None:
+                return result._done(x,None,False,'no sign change found around x0')
+        
+        a,b = float(bracket[0]),float(bracket[1])
+        fa,_ = f(a)
+        fb,_ = f(b)
+        result.evaluations+=2
+        if fa==None or fb==None:
+            raise Exception('The expression cannot be evaluated at the ends of the bracket')
+        if fa==0:
+            return result._done(a,fa,True,'root at the end of the bracket')
+        if fb==0:
+            return result._done(b,fb,True,'root at the end of the bracket')
+        if np.sign(fa)==np.sign(fb):
+            raise Exception('The expression must have different signs at the ends of the bracket')
+        result = _bracketed_root(f,a,b,fa,fb,x0,tol,maxiter,result)
+        if result.converged and abs(result.function_value)>max(abs(fa),abs(fb)):
+            # the sign changes across a pole rather than a root
+            result.converged = False
+            result.message = 'the sign change is a pole'
+        return result
+
+    def find_roots(self,var:str,a:float,b:float,samples:int=1000,tol:float=1e-12,maxiter:int=100,val_dict:dict={})->list:
+        # Every root in [a,b] that the expression changes sign over between neighbouring samples
+        # The expression is evaluated on all samples at once, each sign change is refined by find_root
+        # and sign changes across poles are dropped
+        '''
+        >>> [round(r,9) for r in expr('sin(x)').find_roots('x',-1,7)]
+        [0.0, 3.141592654, 6.283185307]
+        '''
+        x = np.linspace(a,b,samples)
+        with np.errstate(all='ignore'):
+            y = _real_values(expr(root=_solver_root(self.root)).evaluate_array(val_dict={**val_dict,var:x}),x.shape)
+        roots = [float(r) for r in x[y==0]]
+        signs = np.sign(y)
+        for i in np.nonzero(signs[:-1]*signs[1:]<0)[0]:
+            result = self.find_root(var,bracket=(x[i],x[i+1]),tol=tol,maxiter=maxiter,val_dict=val_dict)
+            if result.converged:
+                roots.append(float(result.root))
+        return sorted(roots)
+
+    def estimate_batch(self,var:str,val_dict:dict,x0=None,bracket:tuple=None,tol:float=1e-12,maxiter:int=100,full_output:bool=False):
+        # Solves the expression for var once for every set of values in val_dict, the arrays are broadcast together
+        # Every instance (lane) iterates at the same time: each step evaluates f and df/dvar of all lanes that have not
+        # converged with one call of a compiled numpy function. With a bracket (arrays or numbers) Newton steps that leave
+        # the bracket or do not halve the step are replaced by bisection. Without one Newton starts at x0 (0.5 by default)
+        # and lanes where it fails are solved one at a time by find_root
+        # Returns an array of roots that is NaN where no root was found, with full_output=True also an array of whether
+        # each lane converged and an array of the iterations each lane took
+        '''
+        >>> expr('x*e^x=b').estimate_batch('x',{'b':np.array([1,2,3])}).round(6)
+        array([0.567143, 0.852606, 1.049909])
+        '''
+        compiled,others = _solver_compiled(self.root,var,array=True)
+        for v in others:
+            if v not in val_dict:
+                raise Exception(f'{v}: no values given')
+        ends = [] if bracket==None else list(bracket)
+        arrays = np.broadcast_arrays(*[np.asarray(val_dict[v],dtype=float) for v in others],
+                                     np.asarray(0.5 if x0==None else x0,dtype=float),
+                                     *[np.asarray(end,dtype=float) for end in ends])
+        shape = arrays[0].shape
+        arrays = [a.ravel().copy() for a in arrays]
+        values,x = arrays[:len(others)],arrays[len(others)]
+        start = x.copy()
+
+        roots = np.full(x.size,np.nan)
+        converged = np.zeros(x.size,dtype=bool)
+        iterations = np.zeros(x.size,dtype=int)
+
+        def evaluate(lanes,at):
+            # f and df/dvar of the lanes at the points at, NaN where undefined
+            with np.errstate(all='ignore'):
+                fx,dfx = compiled(at,*[v[lanes] for v in values])
+            return _real_values(fx,at.shape),_real_values(dfx,at.shape)
+
+        everything = np.arange(x.size)
+        if bracket!=None:
+            a,b = arrays[-2],arrays[-1]
+            fa,_ = evaluate(everything,a)
+            fb,_ = evaluate(everything,b)
+            limit = np.maximum(np.abs(fa),np.abs(fb))   # |f| at a root is below |f| at the ends, otherwise it is a pole
+            for end,f_end in ((a,fa),(b,fb)):
+                roots[f_end==0] = end[f_end==0]
+                converged|= f_end==0
+            active = ~converged & (np.sign(fa)!=np.sign(fb)) & ~np.isnan(fa) & ~np.isnan(fb)
+            x = np.where((a<x)&(x<b)|(b<x)&(x<a),x,(a+b)/2)
+            step = np.abs(b-a)
+            retries = np.zeros(x.size,dtype=int)  # undefined points in a row, tries other points of the bracket
+            for _ in range(maxiter):
+                lanes = np.nonzero(active)[0]
+                if len(lanes)==0:
+                    break
+                iterations[lanes]+=1
+                xl = x[lanes]
+                fx,dfx = evaluate(lanes,xl)
+
+                undefined = np.isnan(fx)
+                retries[lanes] = np.where(undefined,retries[lanes]+1,0)
+                active[lanes[undefined&(retries[lanes]>3)]] = False
+
+                exact = fx==0
+                roots[lanes[exact]] = xl[exact]
+                converged[lanes[exact]] = True
+
+                defined = ~undefined
+                same = defined & (np.sign(fx)==np.sign(fa[lanes]))
+                a[lanes[same]],fa[lanes[same]] = xl[same],fx[same]
+                other = defined & ~same
+                b[lanes[other]],fb[lanes[other]] = xl[other],fx[other]
+
+                al,bl = a[lanes],b[lanes]
+                with np.errstate(all='ignore'):
+                    newton = xl-fx/dfx
+                take = np.isfinite(newton) & ((al<newton)&(newton<bl)|(bl<newton)&(newton<al)) & (np.abs(newton-xl)<=step[lanes]/2)
+                fraction = np.array([0.5,0.382,0.618])[retries[lanes]%3]
+                new = np.where(take,newton,al+fraction*(bl-al))
+                done = defined & ~exact & ((np.abs(new-xl)<=tol*(1+np.abs(xl)))|(np.abs(bl-al)<=tol*(1+np.abs(xl))))
+                roots[lanes[done]] = new[done]
+                converged[lanes[done]] = True
+
+                step[lanes] = np.abs(new-xl)
+                x[lanes] = new
+                active[lanes[exact|done]] = False
+
+            # sign changes across poles are not roots
+            found = np.nonzero(converged)[0]
+            fx,_ = evaluate(found,roots[found])
+            pole = found[~(np.abs(fx)<=limit[found])]
+            roots[pole] = np.nan
+            converged[pole] = False
+        else:
+            active = np.ones(x.size,dtype=bool)
+            for _ in range(maxiter):
+                lanes = np.nonzero(active)[0]
+                if len(lanes)==0:
+                    break
+                iterations[lanes]+=1
+                fx,dfx = evaluate(lanes,x[lanes])
+                with np.errstate(all='ignore'):
+                    step = fx/dfx
+                failed = ~np.isfinite(step)
+                x[lanes] = x[lanes]-np.where(failed,0,step)
+                done = ~failed & (np.abs(step)<=tol*(1+np.abs(x[lanes])))
+                roots[lanes[done]] = x[lanes[done]]
+                converged[lanes[done]] = True
+                active[lanes[done|failed]] = False
+
+            # lanes where Newton failed are solved one at a time
+            for lane in np.nonzero(~converged)[0]:
+                result = self.find_root(var,x0=start[lane],tol=tol,maxiter=maxiter,val_dict={v:values[i][lane] for i,v in enumerate(others)})
+                iterations[lane]+=result.iterations
+                if result.converged:
+                    roots[lane] = result.root
+                    converged[lane] = True
+
+        if full_output:
+            return roots.reshape(shape),converged.reshape(shape),iterations.reshape(shape)
+        return roots.reshape(shape)
+
+    def num_int(self,a,b,var,precision:int=3,tol:float=None,full_output:bool=False):
+        # Integral of the expression over var from a to b by adaptive Gauss-Kronrod quadrature
+        # Every interval is integrated with the 15 point Kronrod rule and the 7 point Gauss rule that
+        # shares its nodes, their difference is the error estimate of the interval. Intervals whose error
+        # is too large are halved and only those halves are evaluated in the next round, the integrand
+        # is evaluated on every pending interval at once with evaluate_array
+        # tol is the relative error allowed, by default it is set from precision (significant digits)
+        # The result is rounded to precision significant digits (the real and imaginary parts separately),
+        # with full_output=True the unrounded integral and its error estimate are returned instead
+        # Without full_output an integral that does not converge within tol (a pole inside [a,b] or a
+        # divergent integral) raises an exception, with full_output the error estimate shows it
+        '''
+        >>> expr('x^2').num_int(1,2,'x')
+        2.33
+        >>> value,error = expr('sin(x)').num_int(0,3,'x',full_output=True)
+        >>> bool(abs(value-(1-np.cos(3)))<1e-12 and error<1e-10)
+        True
+        '''
+        if a==b:    # empty interval, the tolerance below is relative to its width
+            return (0.0,0.0) if full_output else 0.0
         if self.evaluate(val_dict={var:np.random.rand()})==None:
             raise Exception('Cannot perform numerical Integration')
+        if tol==None:
+            tol = 10.0**-(precision+2)
         
-        n = 200000
-        l = self.left_Rsum(n,a,b,var)
-        r = self.right_Rsum(n,a,b,var)
-        counter = 0
-        while f'{l:.{precision}e}'!=f'{r:.{precision}e}':
-            n+=200000
-            l = self.left_Rsum(n,a,b,var)
-            r = self.right_Rsum(n,a,b,var)
-        
-        return float(f'{l:.{precision-1}e}')
+        lower = np.array([a],dtype=float)   # intervals that still need to be integrated
+        upper = np.array([b],dtype=float)
+        total = 0       # integral and error estimate of the accepted intervals
+        error = 0
+        scale = 0       # integral of |f| over the accepted intervals, sets the absolute tolerance
+        for _ in range(50):
+            half = (upper-lower)/2
+            x = (lower+upper)[:,None]/2+half[:,None]*_kronrod_nodes
+            with np.errstate(all='ignore'):
+                f = np.asarray(self.evaluate_array(val_dict={var:x}))
+            kronrod = half*(f@_kronrod_weights)
+            gauss = half*(f@_gauss_weights)
+            interval_error = np.abs(kronrod-gauss)
+            interval_scale = np.abs(half)*(np.abs(f)@_kronrod_weights)
+
+            # an interval is accepted when its error is within its share of the tolerance
+            defined = ~np.isnan(kronrod)
+            allowed = tol*max(scale+np.sum(interval_scale[defined]),np.finfo(float).tiny)*np.abs(half)/(np.abs(b-a)/2)
+            accept = defined & (interval_error<=allowed)
+            total += np.sum(kronrod[accept])
+            error += np.sum(interval_error[accept])
+            scale += np.sum(interval_scale[accept])
+            if accept.all():
+                break
+
+            # the rest are halved, intervals where the integrand is undefined at a node are halved as well
+            # so the node moves off the point
+            lower,upper = lower[~accept],upper[~accept]
+            middle = (lower+upper)/2
+            lower,upper = np.concatenate([lower,middle]),np.concatenate([middle,upper])
+            if len(lower)>100000:
+                break
+
+        if not accept.all():
+            if not defined.all():
+                raise Exception('Cannot perform numerical Integration')
+            # did not converge, the unconverged intervals are included with their error
+            total += np.sum(kronrod[~accept])
+            error += np.sum(interval_error[~accept])
+            scale += np.sum(interval_scale[~accept])
+
+        total = complex(total) if np.iscomplexobj(total) else float(total)
+        if full_output:
+            return total,float(error)
+        if not accept.all() and not error<=tol*scale:
+            # integrable singularities still converge, a pole or a divergent integral does not
+            raise Exception(f'Numerical integration did not converge, error estimate {float(error):.3g}')
+        if isinstance(total,complex):
+            return complex(float(f'{total.real:.{precision-1}e}'),float(f'{total.imag:.{precision-1}e}'))
+        return float(f'{total:.{precision-1}e}')
 
     def right_Rsum(self,n,a,b,var):
         w = (b-a)/n
-        s = 0
-        x = a+w
-        for i in range(n-1):
-            x+=w
-            s+= self.evaluate(val_dict={var:x})*w
-        return s
+        x = a+w*np.arange(2,n+1)
+        return np.sum(self.evaluate_array(val_dict={var:x}))*w
 
     def left_Rsum(self,n,a,b,var):
         w = (b-a)/n
-        s = 0
-        x = a
-        for i in range(n-1):
-            x+=w
-            s+= self.evaluate(val_dict={var:x})*w
-        return s
-
-    def map(self,base = None,path = []):
-        # Sets the index of the variable to the value index
-        # Returns a dict of 'variable' and [path] pairs
-        # path is an ordered list of '1/0'
-        # Going left and right for 1,0 respectfully will lead to 'variable'
-
-        if base == None:
-            base = self.root
-
-        if base.right==None and isinstance(base.val,str):    # Case in which base is a variable save the current path to self.dir
-            if base.val not in self.dir:
-                self.dir[base.val] = []                      # Instantiate list for var
-            
-            if path not in self.dir[base.val]:      # only unique paths are added to self.dir for a given var
-                self.dir[base.val].append(path)     # Append current path
-            
-        
-        # Include arbitrary functions in self.dir
-        arbitrary_function = base.right!=None and isinstance(base.right.val,list)
+        x = a+w*np.arange(1,n)
+        return np.sum(self.evaluate_array(val_dict={var:x}))*w
 
-        if not arbitrary_function:
-            if base.left is not None:
-                self.map(base.left,path+[1])
-
-            if base.right is not None:
-                self.map(base.right,path+[0])
-        
-        else: # aritrary function
-            if base.val not in self.dir:
-                self.dir[base.val] = []        # Instantiate list for var
-            self.dir[base.val].append(path)    # Append current path
+    def map(self):
+        # Rebuilds the index of the variables from root and returns it, see dir
+        self._paths_root = None
+        return self.dir
 
     def __str__(self):
         # Returns a string expression that is an equivalent expression to the graph
@@ -411,8 +701,19 @@ class expr:
         (a+b)*c
         """
         # initial call to _str_aux
+        if self._printed!=None and self._printed[0] is self.root:
+            return _str_aux(self._printed[1])   # the expression as it was written before it was folded
         return _str_aux(self.root)
 
+    def fold(self):
+        # Returns the expression with subtrees without variables replaced by their values, see fold_constants
+        '''
+        >>> a = expr('x*e^((pi*1j*30)/180)').fold()
+        >>> a.root.right.val
+        (0.8660254037844387+0.49999999999999994j)
+        '''
+        return expr(root=fold_constants(self.root))
+
     def invert_branch(self,var:str,include_var:bool=False):
         # Used for generating symbolic algebraic solutions to equations
         # inverts a particular path of the tree
@@ -536,10 +837,11 @@ class expr:
         root=self.root
 
 
-        if var not in self.dir:
+        paths = self._index()
+        if var not in paths:
             raise Exception(f'\'{var}\' not found in Expression')
 
-        path = self.dir[var][0] # if path is not specified takes the first path in dir
+        path = _decode_path(paths[var][0]) # if path is not specified takes the first path in dir
         C = 0 if self.evaluate()==None else self.evaluate() # seed to begin the inversion is either the current evaluation or 0
         
         # Case where the initial node is an equivalence operation
@@ -572,182 +874,68 @@ class expr:
     def pD(self,var):
         # This process evaluates the derivative using dC/dx = 0, d(x)/dx = 1 and every mapping
         # of a d(f)/dx where f is a function of x
-        root = self._partial_D_aux(self.root,var)
-        root = reduce(root)
-        root = common_form(root)        # reduce and common_form make the expression tree readable by trimming "extra" information
-        root = reduce(root)
+        # Results are saved in derivative_cache so the derivative of a tree is only worked out once
+        key = (self.root,var)
+        root = derivative_cache.get(key)
+        if root is None:
+            root = self._partial_D_aux(self.root,var)
+            root = reduce(root)
+            root = common_form(root)        # reduce and common_form make the expression tree readable by trimming "extra" information
+            derivative_cache.put(key,root)
         return expr(root=root)
         
-        
     def _partial_D_aux(self,root,var=''):
+        # Derivative of the tree at root with the rules of _d_rules, before it is simplified
+        # Every distinct subtree is differentiated once, the results are shared between the places the
+        # subtree occurs and the derivative shares the subtrees of the original expression
         if var=='':
             raise Exception(f'df/d"x" not defined in partial derivative')
-        # a is the root of an expr with left and right components
-        # below is a map of derivative rules written as da/dvar where left and right
-        # nodes of a are assummed to be functions of var
-        
-        d_map = {                   # df/dx where f(x)
-            '+':lambda a,var: node( # f+g => f'+g'
-                '+',self._partial_D_aux(a.left,var),self._partial_D_aux(a.right,var)),
-            '-':lambda a,var: node( # f-g => f'-g'
-                '-',self._partial_D_aux(a.left,var),self._partial_D_aux(a.right,var)),
-            '*':lambda a,var: node( # f*g => f'g+fg'
-                '+',
-                left = node('*',self._partial_D_aux(a.left,var),a.right),
-                right = node('*',a.left,self._partial_D_aux(a.right,var))),
-            '/':lambda a,var:node(  # f/g => (f'*g-f*g')/(g^2)
-                '/',
-                left=node(
-                  '-',
-                  left = node('*',a.right,self._partial_D_aux(a.left,var)),
-                  right = node('*',a.left,self._partial_D_aux(a.right,var))
-                ),
-                right = node('^',left = a.right,right=node(2))
-            ),
-
-            '^':lambda a,var:self._power_D(a,var), ## general formula for f^g was too hairy for lambda function
-
-            'sin' :lambda a,var:node( # sin(f)=> f'*cos(f)
-                '*',
-                left = self._partial_D_aux(a.right,var),
-                right = node('cos',right=a.right)
-            ),
-            'cos' :lambda a,var:node( # cos(f)=> -f'*sin(f)
-                '*',
-                left = node('*',node(-1),self._partial_D_aux(a.right,var)),
-                right = node('sin',node(a.right))
-            ),
-            'tan' :lambda a,var:node( # tan(f)=> f'*sec(f)^2
-                '*',
-                left = self._partial_D_aux(a.right,var),
-                right=node(
-                    '^',
-                    left = node('sec',right=a.right),
-                    right = node(2))
-            ),
-            'csc' :lambda a,var:node( # csc(f)=> -f'*csc(f)*cot(f)
-                '*',
-                node(-1),
-                node(
-                    '*',
-                    node(self._partial_D_aux(a.right,var)),
-                    node(
-                        '*',
-                        node('csc',right=a),
-                        node('cot',right=a)
-                    )
-                )
-            ),
-            'cot' :lambda a,var:node( # cot(f) => -f'*csc(f)^2
-                '*',
-                node(-1),
-                node(
-                    '*',
-                    self._partial_D_aux(a.right,var),
-                    node(
-                        '^',
-                        node('csc',right=a),
-                        node(2)
-                    )
-                )
-            ),
-            'asin':lambda a,var:node( # asin(f) => f'/sqrt(1-f^2)
-                node(
-                    '/',
-                    self._partial_D_aux(a.right,var),
-                    node(
-                        '^',
-                        node(
-                            '-',
-                            node(1),
-                            node('^',a,node(2))
-                        ),
-                        node(1/2)
-                    )
-                )
-            ),
-            'acos':lambda a,var:node( # acos(f) => -1*f'/sqrt(1-f^2)
-                node(
-                    '/',
-                    node(
-                        '*',
-                        node(-1),
-                        self._partial_D_aux(a.right,var)
-                    ),
-                    node(
-                        '^',
-                        node(
-                            '-',
-                            node(1),
-                            node('^',a,node(2))
-                        ),
-                        node(1/2)
-                    )
-                )
-            ),
-            'atan':lambda a,var:node( # atan(f) => f'/(1+f^2)
-                '/',
-                self._partial_D_aux(a.right,var),
-                node(
-                    '+',
-                    node(1),
-                    node(
-                        '^',
-                        a.right,
-                        node(2)
-                    )
-                )
-            ),
-            'exp' :lambda a,var:node( # exp(f) => f'*exp(f)
-                '*',left=self._partial_D_aux(a.right,var),right=a),
-            '='   :lambda a,var:node( # f=g => f'=g'
-                '=',
-                self._partial_D_aux(a.left,var),
-                self._partial_D_aux(a.right,var)
-            ),
-            'ln':lambda a,var:node(
-                '/',
-                self._partial_D_aux(a.right,var),
-                a.right
-            )
-        }
 
-        if root.val==var:
-            return node(1)
-        
-        elif root.right == None and root.val not in d_map or type(root) in [bool,int,float,complex]:
-            return node(0)
-        
-        return d_map[root.val](root,var) 
+        d = {}          # subtree -> derivative of subtree
+        stack = [root]
+        while stack:
+            a = stack[-1]
+            if a in d:
+                stack.pop()
+                continue
+
+            if a.val==var:
+                d[a] = node(1)
+            elif a.right is None and a.val not in _d_rules:
+                d[a] = node(0)
+            elif a.val not in _d_rules:
+                raise Exception(f'{a.val}: derivative is not defined')
+            else:
+                # children are differentiated before a
+                pending = [c for c in (a.left,a.right) if c is not None and c not in d]
+                if pending:
+                    stack.extend(pending)
+                    continue
+                d[a] = _d_rules[a.val](a,a.left,a.right,d.get(a.left),d.get(a.right),node)
+            stack.pop()
 
+        return d[root]
 
-    def _power_D(self,root,var):# general formula for df/dx(f^g) where f and g are functions of x
-        f = root.left
-        g = root.right
-        
-        # s1 = (g*f')/f
-        s1 = node(
-            '/',
-            left = node(
-                '*',
-                g,
-                self._partial_D_aux(f,var)
-            ),
-            right = f
-        )
-        # s2 = g'*ln(f)
-        s2 = node(
-            '*',
-            left = self._partial_D_aux(g,var),
-            right= node('ln',right=f)
-        )
+    def common_form(self):
+        return expr(root=common_form(self.root))
 
-        s = node('+',s1,s2)
+    def compact(self):
+        # Returns the expression stored as an array_tree, see array_tree
+        return array_tree.from_node(self.root)
 
-        return node('*',left = s,right=root)
+    def to_bytes(self)->bytes:
+        # Serializes the tree into a flat binary form, see array_tree.to_bytes
+        '''
+        >>> a = expr('x^2+sin(y)')
+        >>> expr.from_bytes(a.to_bytes()).root is a.root
+        True
+        '''
+        return self.compact().to_bytes()
 
-    def common_form(self):
-        return expr(root=common_form(self.root))
+    @classmethod
+    def from_bytes(cls,data):
+        # Expression of bytes (or a buffer) written by to_bytes
+        return cls(root=array_tree.from_bytes(data).to_node())
 
     def replace(self,var:str, sub):
         # sub can be a root, val or string describing an expression
@@ -755,24 +943,25 @@ class expr:
         if type(sub) in [bool,int,float,complex]:
             sub = node(sub)
         elif isinstance(sub,str):
-            sub = expr(sub).root
-        
-        self.dir = {}   # reinstantiates dir to have most current map
-        self.map()
-        if var in self.dir:
-            for path in self.dir[var]:
-                temp = self.root
-                for left in path[:-1]:
-                    temp = temp.left if left else temp.right
-
-                if path[-1]:
-                    temp.left =sub
-                else:
-                    temp.right = sub
+            sub = self.exp2tree(sub)
         
+        paths = self._index()
+        if var in paths:
+            moved = paths.pop(var)
+            self.root = _set_paths(self.root,moved,sub)   # nodes are immutable so the paths to var are rebuilt
+
+            # the index is updated in place: the variables of sub are now found below every path that led to var
+            for v,sub_paths in _var_paths(sub).items():
+                var_paths = paths.setdefault(v,[])
+                var_paths.extend(_join_paths(path,sub_path) for path in moved for sub_path in sub_paths)
+                var_paths.sort(key=_path_order)
+            self._paths_root = self.root
+            self._dir = None
+
     
-    def simplify(self):
-        pass
+    def simplify(self,node_limit:int=10000,time_limit:float=1.0):
+        # Returns the cheapest equal expression that simplify() finds within the limits, see simplify
+        return expr(root=simplify(self.root,node_limit,time_limit))
 
     def integrate(self,root,var):
         # TODO Not sure how to proceed with task
@@ -810,111 +999,842 @@ class expr:
                 )
             )
 
+    def derivatives(self,var:str,n:int)->list:
+        # Returns [f, df/dvar, ..., d^n(f)/dvar^n] as expr objects where f is this expression
+        # Each order is the derivative of the simplified order before it. The orders are saved on the
+        # expression so asking for more orders later only works out the new ones
+        '''
+        >>> [str(d) for d in expr('x^3').derivatives('x',3)]
+        ['x^3', '3*x^2', '6*x', '6']
+        '''
+        tower = self._derivatives.get(var)
+        if tower==None or tower[0] is not self.root:
+            tower = self._derivatives[var] = [self.root]
+        while len(tower)<=n:
+            tower.append(expr(root=tower[-1]).pD(var).root)
+        return [expr(root=root) for root in tower[:n+1]]
+
     def taylor_series(self,var,a,depth):
-        # D is the expression that represents the current derivative
         # Taylor series is defined as Sum(D^n(f(a))/n!*(x-a)^n) :Where D is a derivative operator
-        # Assumes xo is a leaf type
+        # The derivatives come from derivatives(). When a is a number and the derivatives only depend on var
+        # every coefficient is evaluated at a by one call of a compiled function, otherwise
+        # (or where a coefficient cannot be evaluated, like e^0) a is substituted into the derivative,
+        # which is then reduced and folded to a number when it has no other variables
+        '''
+        >>> t = expr('e^x').taylor_series('x',0,3)
+        >>> print(t)
+        1+1.0/1*(x-0)^1+1.0/2*(x-0)^2+1.0/6*(x-0)^3
+        >>> round(t.evaluate(val_dict={'x':0.5}),6)
+        1.645833
+        '''
         if depth<1:
             raise Exception('Depth of taylor series needs to b greator than 1')
         
-        temp = expr(root=_copy(self.root))          # 0th derivative of self
-        next_temp = temp.pD(var)                    # 1st derivaive of self
-        temp.replace(var,a)                         # In the copy of self replace var with a
-        root = node(
-            '+',
-            temp.root,
-            self._taylor_aux(next_temp,var,a,depth-1,1)
-        )
+        tower = [d.root for d in self.derivatives(var,depth)]
+        sub = self.exp2tree(a) if isinstance(a,str) else node(a)
+
+        coefficients = [None]*len(tower)
+        if type(a) in [int,float,complex] and set().union(*map(_variables,tower))<={var}:
+            values = _compile_roots(tower,(var,),array=True)(a)
+            for n,value in enumerate(values):
+                value = np.asarray(value).item()
+                if not np.isnan(value):
+                    coefficients[n] = node(_number(value)+0)     # +0 turns -0.0 into 0.0
+        memo = {}
+        fold_memo = {}
+        coefficients = [c if c!=None else fold_constants(reduce(_substitute(root,var,sub,memo)),fold_memo) for c,root in zip(coefficients,tower)]
+
+        # Sum of the terms with the highest order innermost
+        root = None
+        for n in range(depth,-1,-1):
+            term = coefficients[n] if n==0 else node(
+                '*',
+                node('/',coefficients[n],node(_factorial(n))),
+                node(
+                    '^',
+                    node('-',node(var),sub),
+                    node(n)
+                )
+            )
+            root = term if root==None else node('+',term,root)
 
         return expr(root = root)
 
-    def _taylor_aux(self,f_prime,var,a,depth:int,n:int):
-        
-        temp = expr(root = _copy(f_prime.root))
-        next_temp = temp.pD(var)
-        temp.replace(var,a)
-        # Constructs current term in the summation
-        polynomial = node(
-            '*',
-            node('/',f_prime.root,node(_factorial(n))),
-            node(
-                '^',
-                node('-',node(var),node(a)),
-                node(n)
-            )
-        )
-        if depth==0:
-            return polynomial
-        
-        # Recursively calls the next term of the series
-        return node(
-            '+',
-            polynomial,
-            self._taylor_aux(next_temp,var,a,depth-1,n+1))
-
 def _factorial(n):
     # factorial is built on 0!=1 and n! = n*(n-1)!
     if n==0:
         return 1
     return n*_factorial(n-1)
 
+_value_types = [bool,int,float,complex]   # types of node vals that are values rather than variables or operators
+
+_constants = {  # symbols that always evaluate to a constant
+    'pi':np.pi,
+    'e':np.e,
+    'i':1j
+}
+
+_operators = {    # Operators with 2 inputs
+    '+':lambda a,b: a+b,
+    '-':lambda a,b: a-b,
+    '/':lambda a,b: a/b if b!= 0 else None,
+    '*':lambda a,b: a*b,
+    '^':lambda a,b: a**b if (a and b)!=0 else None,
+    '&':lambda a,b: a&b,
+    '|':lambda a,b: a|b,
+    '%':lambda a,b: a%b,
+    '>':lambda a,b:a>b,
+    '<':lambda a,b:a<b,
+    '>=':lambda a,b:a>=b,
+    '<=':lambda a,b:a<=b,
+    '==': lambda a,b: a==b
+}
+
+_single_operators={          # operators with single inputs
+    '!':lambda a:not a,
+    'cos':lambda a: np.cos(a),
+    'sin':lambda a: np.sin(a),
+    'tan':lambda a: np.tan(a),
+    'sec':lambda a: 1/np.cos(a),
+    'csc': lambda a: 1/np.sin(a),
+    'cot': lambda a: 1/np.tan(a),
+    'asin': lambda a: np.arcsin(a),
+    'acos': lambda a: np.arccos(a),
+    'atan':lambda a : np.arctan(a),
+    'ln': lambda a: np.log(a),
+    'exp': lambda a:np.exp(a)
+}
+
+def _assign(left,right):
+    # Value of an '=' node
+    # Returns left or right if they are valued datatypes
+    if type(left) in _value_types:
+        return left
+    elif type(right) in _value_types:
+        return right
+    return None
+
+# Templates used by _codegen to write each operation as a single python expression
+# {0} and {1} are the left and right operands
+_binary_templates = {
+    '+':'{0}+{1}',
+    '-':'{0}-{1}',
+    '/':'({0}/{1} if {1}!=0 else None)',
+    '*':'{0}*{1}',
+    '^':'({0}**{1} if ({0} and {1})!=0 else None)',
+    '&':'{0}&{1}',
+    '|':'{0}|{1}',
+    '%':'{0}%{1}',
+    '>':'{0}>{1}',
+    '<':'{0}<{1}',
+    '>=':'{0}>={1}',
+    '<=':'{0}<={1}',
+    '==':'{0}=={1}'
+}
+_single_templates = {
+    '!':'not {0}',
+    'cos':'_np.cos({0})',
+    'sin':'_np.sin({0})',
+    'tan':'_np.tan({0})',
+    'sec':'1/_np.cos({0})',
+    'csc':'1/_np.sin({0})',
+    'cot':'1/_np.tan({0})',
+    'asin':'_np.arcsin({0})',
+    'acos':'_np.arccos({0})',
+    'atan':'_np.arctan({0})',
+    'ln':'_np.log({0})',
+    'exp':'_np.exp({0})'
+}
+_none_operators = ['/','^']     # operators that can return None for valued operands
+_unset = object()   # value of the names of compiled code whose subtree has not been evaluated yet
+
+# Templates for array evaluation, operations missing here use the templates above
+# None is replaced by NaN so special cases become masks
+_array_binary_templates = {
+    '/':'_divide({0},{1})',
+    '^':'_power({0},{1})',
+    '&':'_np.logical_and({0},{1})',
+    '|':'_np.logical_or({0},{1})'
+}
+_array_single_templates = {
+    '!':'_np.logical_not({0})'
+}
+
+def _divide(a,b):
+    # Elementwise a/b that is NaN where b is 0
+    with np.errstate(divide='ignore',invalid='ignore'):
+        return np.where(np.asarray(b)!=0,np.true_divide(a,b),np.nan)
+
+def _power(a,b):
+    # Elementwise a^b that is NaN where a or b is 0, matching the '^' operator
+    # Integers are raised as floats so negative powers and large results are valid
+    # A negative base with a fractional exponent is complex like it is for python numbers, so the
+    # result is complex when that happens anywhere in the arrays
+    a,b = np.asarray(a),np.asarray(b)
+    if a.dtype.kind in 'biu':
+        a = a.astype(float)
+    with np.errstate(divide='ignore',invalid='ignore',over='ignore'):
+        if a.dtype.kind=='f' and np.any((a<0)&(b!=np.round(b))):
+            a = a.astype(complex)
+        return np.where((a!=0)&(b!=0),np.power(a,b),np.nan)
+
+def _assign_array(left,right):
+    # Elementwise value of an '=' node, left where it has a value otherwise right
+    return np.where(np.isnan(left),right,left)
+
+# Gauss-Kronrod 7-15 quadrature on [-1,1], used by expr.num_int
+# The 7 Gauss nodes are every second Kronrod node, _gauss_weights is 0 on the other nodes
+_kronrod_nodes = np.array([
+    0.991455371120812639206854697526329,
+    0.949107912342758524526189684047851,
+    0.864864423359769072789712788640926,
+    0.741531185599394439863864773280788,
+    0.586087235467691130294144845693013,
+    0.405845151377397166906606412076961,
+    0.207784955007898467600689403773245,
+    0.0])
+_kronrod_weights = np.array([
+    0.022935322010529224963732008058970,
+    0.063092092629978553290700663189204,
+    0.104790010322250183839876322541518,
+    0.140653259715525918745189590510238,
+    0.169004726639267902826583426598550,
+    0.190350578064785409913256402421014,
+    0.204432940075298892414161999234649,
+    0.209482141084727828012999174891714])
+_gauss_weights = np.array([
+    0,0.129484966168869693270611432679082,
+    0,0.279705391489276667901467771423780,
+    0,0.381830050505118944950369775488975,
+    0,0.417959183673469387755102040816327])
+_kronrod_nodes = np.concatenate([-_kronrod_nodes,_kronrod_nodes[-2::-1]])
+_kronrod_weights = np.concatenate([_kronrod_weights,_kronrod_weights[-2::-1]])
+_gauss_weights = np.concatenate([_gauss_weights,_gauss_weights[-2::-1]])
+
+def _variables(root):
+    # Returns a sorted tuple of the variables in a tree
+    # Constants such as pi and names of arbitrary functions are not variables
+    found = set()
+    stack = [root]
+    while stack:
+        base = stack.pop()
+        if base==None or isinstance(base.val,list):
+            continue
+        if isinstance(base.val,str) and base.right==None:
+            if base.val not in _constants:
+                found.add(base.val)
+            continue
+        stack += [base.left,base.right]
+    return tuple(sorted(found))
+
+def _codegen(roots,args,array=False):
+    # Lowers trees to the source of a python function
+    # Each node becomes one statement 't<n> = ...' so the generated code is flat regardless of depth
+    # Returns the source and the list of constants it refers to as c<n>
+    # A reference is either a python literal or a local name, 'maybe_none' tracks whether it can be None
+    # array=True generates numpy code where None is NaN and no None checks are needed
+    # Like _evaluate_aux the left side of an operation is only evaluated when the right side has a value:
+    # it is generated in a block, a flag 'k<n> = <right> is not None' and statements 'if k<n>: ...', so the
+    # code stays flat however deep the blocks nest. A subtree that was generated in a block and is used
+    # outside of it is generated again where it is used, in a block of 't<n> is _unset', so every subtree
+    # is still evaluated at most once
+    slots = {var:f'a{i}' for i,var in enumerate(args)}
+    consts = []
+    lines = []
+    missing = '_np.nan' if array else 'None'
+    binary_templates = {**_binary_templates,**_array_binary_templates} if array else _binary_templates
+    single_templates = {**_single_templates,**_array_single_templates} if array else _single_templates
+
+    def const(val):
+        if type(val) in [bool,int]:
+            return f'({val!r})' if val<0 else repr(val)    # -1**2 would be -(1**2)
+        consts.append(val)
+        return f'c{len(consts)-1}'
+
+    def emit(line,context):
+        lines.append(f'        if k{context[-1]}: {line}' if context else f'        {line}')
+
+    def block(condition,context):
+        # opens a block, returns the context of the statements in it
+        flag = len(blocks)
+        blocks.append(None)
+        lines.append(f'        k{flag} = k{context[-1]} and {condition}' if context else f'        k{flag} = {condition}')
+        return context+(flag,)
+
+    leaves = {}     # id(node) -> (reference, maybe_none) of leaves and of subtrees that are not evaluated
+    temps = {}      # id(node) -> [name, maybe_none] of operations, shared by all roots so each distinct subtree is generated once
+    valid = {}      # id(node) -> contexts (tuples of block numbers) where the name of an operation has its value
+    unset = []      # names that are set to _unset first since they are used outside of their block
+    blocks = []
+
+    def ref(a):
+        return leaves[id(a)] if id(a) in leaves else tuple(temps[id(a)])
+
+    def is_leaf(base):
+        # leaves and arbitrary functions are not operations
+        return base.right==None or isinstance(base.val,list) or (isinstance(base.val,str) and isinstance(base.right.val,list))
+
+    def leaf(base):
+        # reference of a node that is not an operation
+        if isinstance(base.val,list) or (isinstance(base.val,str) and base.right!=None and isinstance(base.right.val,list)):
+            return (missing,not array)
+        if isinstance(base.val,str) and base.right==None:
+            if base.val in _constants:
+                return (const(_constants[base.val]),False)
+            elif base.val in slots:
+                return (slots[base.val],not array)
+            return (missing,not array)
+        return (const(base.val),False) if type(base.val) in _value_types else (missing,not array)
+
+    outputs = []
+    for root in roots:
+        stack = [('visit',root,(),False)]
+        while stack:
+            task,base,context,extra = stack.pop()
+            if task=='visit':
+                if id(base) in leaves:
+                    continue
+                if id(base) not in temps:
+                    if is_leaf(base):
+                        leaves[id(base)] = leaf(base)
+                        continue
+                    temps[id(base)] = [f't{len(temps)}',not array]
+                    valid[id(base)] = []
+                elif not extra:
+                    if any(context[:len(c)]==c for c in valid[id(base)]):
+                        continue
+                    # generated in a block that does not contain this one
+                    name = temps[id(base)][0]
+                    if name not in unset:
+                        unset.append(name)
+                    stack.append(('valid',base,context,None))
+                    stack.append(('visit',base,block(f'{name} is _unset',context),True))
+                    continue
+
+                if base.val in binary_templates and base.left!=None and base.val!='=':
+                    stack.append(('binary',base,context,None))
+                    stack.append(('visit',base.right,context,False))
+                else:
+                    stack.append(('emit',base,context,None))
+                    children = [base.left,base.right] if base.val=='=' else [base.right]
+                    stack += [('visit',c,context,False) for c in children if c!=None]
+
+            elif task=='binary':
+                r,r_none = ref(base.right)
+                left = base.left
+                ready = is_leaf(left) or id(left) in temps and any(context[:len(c)]==c for c in valid[id(left)])
+                if r_none and not ready:
+                    # the left side is only evaluated when the right side has a value
+                    emit(f'{temps[id(base)][0]} = None',context)
+                    inner = block(f'{r} is not None',context)
+                    stack.append(('emit',base,inner,context))
+                    stack.append(('visit',base.left,inner,False))
+                else:
+                    stack.append(('emit',base,context,None))
+                    stack.append(('visit',base.left,context,False))
+
+            elif task=='valid':
+                valid[id(base)].append(context)
+
+            else:   # 'emit', extra is the context the value is valid in when it differs from the one of the statement
+                name = temps[id(base)][0]
+                r,r_none = ref(base.right)
+                if base.val=='=':
+                    l,_ = ref(base.left) if base.left!=None else (missing,not array)
+                    expression,none = f'{"_assign_array" if array else "_assign"}({l},{r})',not array
+                elif base.val in single_templates:
+                    expression = single_templates[base.val].format(r)
+                    if r_none:
+                        expression = f'None if {r} is None else {expression}'
+                    none = r_none
+                elif base.val in binary_templates and base.left!=None:
+                    l,l_none = ref(base.left)
+                    expression = binary_templates[base.val].format(l,r)
+                    checks = [f'{ref} is None' for ref,none in [(r,r_none and extra==None),(l,l_none)] if none]
+                    if checks:
+                        expression = f'None if {" or ".join(checks)} else {expression}'
+                    none = bool(checks) or extra!=None or (base.val in _none_operators and not array)
+                else:
+                    expression,none = missing,not array
+                emit(f'{name} = {expression}',context)
+                temps[id(base)][1] = none
+                valid[id(base)].append(context if extra==None else extra)
+        outputs.append(ref(root)[0])
+
+    params = ','.join(f'a{i}={missing}' for i in range(len(args)))
+    result = outputs[0] if len(outputs)==1 else '('+','.join(outputs)+',)'
+    source = '\n'.join(
+        [f'def _factory({",".join(f"c{i}" for i in range(len(consts)))}):',
+         f'    def _compiled({params}):']
+        + [f'        {name} = _unset' for name in unset]
+        + lines
+        + [f'        return {result}',
+           '    return _compiled'])
+    return source,consts
+
+def _compile_roots(roots,args,array=False):
+    # Executes the source generated by _codegen and returns the resulting function
+    # With a single root the function returns a value, otherwise a tuple of values
+    args = tuple(args)
+    source,consts = _codegen(roots,args,array)
+    namespace = {
+        '_np':np,
+        '_unset':_unset,
+        '_assign':_assign,
+        '_assign_array':_assign_array,
+        '_divide':_divide,
+        '_power':_power
+    }
+    exec(source,namespace)
+    f = namespace['_factory'](*consts)
+    f.args = args
+    f.root = roots[0] if len(roots)==1 else tuple(roots)
+    f.source = source
+    f.info = _cse_info(roots)
+    return f
+
+def _cse_info(roots):
+    # Returns how many operations evaluating the trees at roots takes
+    # 'operations': operations when every occurrence of a subtree is evaluated, 'evaluated': distinct operations
+    # that are evaluated once each (nodes are interned so repeated subtrees are the same node), 'saved': the difference
+    counts = {}     # node -> operations of the subtree with every occurrence counted
+    stack = list(roots)
+    while stack:
+        a = stack[-1]
+        if a in counts:
+            stack.pop()
+            continue
+        pending = [c for c in (a.left,a.right) if c is not None and c not in counts]
+        if pending:
+            stack.extend(pending)
+            continue
+        stack.pop()
+        counts[a] = (a.right is not None)+counts.get(a.left,0)+counts.get(a.right,0)
+
+    operations = sum(counts[root] for root in dict.fromkeys(roots))
+    evaluated = sum(a.right is not None for a in counts)
+    return {'operations':operations,'evaluated':evaluated,'saved':operations-evaluated}
+
+# A token of an expression string, kind is 'operator', 'name' or 'number' and start is its index in the string
+token = namedtuple('token',['kind','val','start'])
+
+# Operators and delimiters, anything between them is a name or number. Spaces inside names and numbers are ignored
+_token_pattern = re.compile(r'''
+    (?P<operator>==|<=|>=|[=<>+\-*/^&|(),])
+    |(?P<name>[A-Za-z][^\s=<>+\-*/^&|(),]*(?:\ +[^\s=<>+\-*/^&|(),]+)*)
+    |(?P<number>[^\s=<>+\-*/^&|(),]+(?:\ +[^\s=<>+\-*/^&|(),]+)*)
+    |\s+''',re.VERBOSE)
+
 def _tokenize(input_str:str)->list:
-    # Tokenize a string into a list of the macro elements of the exp
-    # For each reserved command replace it with itself padded. 
+    # Scans a string once and returns its tokens in order
     """
-    >>> _tokenize('a+b')
+    >>> [t.val for t in _tokenize('a+b')]
     ['a', '+', 'b']
-    >>> _tokenize('a==b')
+    >>> [t.val for t in _tokenize('a==b')]
     ['a', '==', 'b']
-    >>> _tokenize('a==b=c')
+    >>> [t.val for t in _tokenize('a==b=c')]
     ['a', '==', 'b', '=', 'c']
-    
+    >>> _tokenize('ln(x)+2 5')
+    [token(kind='name', val='ln', start=0), token(kind='operator', val='(', start=2), token(kind='name', val='x', start=3), token(kind='operator', val=')', start=4), token(kind='operator', val='+', start=5), token(kind='number', val='25', start=6)]
     """
-    double_operators = [
-        '==',
-        '<=',
-        '>='
-    ]
-    exp_list = [
-        '=',
-        '(',
-        ')',
-        '+',
-        '-',
-        '*',
-        '/',
-        '^',
-        '|',
-        '&',
-        '>',
-        '<',
-        '!',
-        'ln',
-        ','
-    ]
-    # trig functions and single argument expresssions
-    # are implicitly tokenized if used correctly in an expression
-    initial_tokens = []
-    for e in double_operators:
-        input_str = input_str.replace(e,' '+e+' ')
-    initial_tokens = input_str.split(' ')
-    tokenize_str = []
-    for token in initial_tokens:
-        if token in double_operators:
-            tokenize_str.append(token)
-            continue
-        for e in exp_list:
-            token = token.replace(e,' '+e+' ')
-        tokenize_str+= token.split(' ')
-    
-    tokenize_str = [val for val in tokenize_str if val!='']
+    return [token(match.lastgroup,match.group().replace(' ',''),match.start()) 
+            for match in _token_pattern.finditer(input_str) if match.lastgroup]
+
+def simplify(root,node_limit:int=10000,time_limit:float=1.0,iter_limit:int=30):
+    # Returns the cheapest tree equal to root that is found by equality saturation
+    # The tree is added to an egraph and _simplify_rules are applied to every class until nothing new is found
+    # or the egraph holds node_limit e-nodes, time_limit seconds have passed or iter_limit rounds have run.
+    # The tree with the fewest operations (then the fewest nodes) is taken out of the class of root
+    '''
+    >>> print(expr(root=simplify(expr('a*x+b*x=c').root)))
+    (a+b)*x=c
+    '''
+    graph = egraph()
+    cid = graph.add(root)
+    graph.saturate(_simplify_rules,node_limit,time_limit,iter_limit,cid)
+    return graph.extract(cid)
+
+class egraph:
+    # Equality graph: e-classes of trees that are known to be equal
+    # An e-node is (op,left class,right class), op is the operation name or, for leaves, the leaf node itself.
+    # Classes are merged with a union-find, hashcons finds the class of an e-node so equal trees share e-nodes
+    # and const holds the value of classes that are known to be a number
+    def __init__(self):
+        self.parent = []    # union-find of class ids
+        self.classes = {}   # class id -> [e-nodes]
+        self.hashcons = {}  # canonical e-node -> class id
+        self.const = {}     # class id -> number
+        self.size = 0       # e-nodes added
+
+    def find(self,a):
+        while self.parent[a]!=a:
+            self.parent[a] = self.parent[self.parent[a]]
+            a = self.parent[a]
+        return a
+
+    def canonical(self,enode):
+        op,l,r = enode
+        return (op,None if l==None else self.find(l),None if r==None else self.find(r))
+
+    def add_enode(self,enode):
+        # Returns the class of enode, a new class if the e-node is not in the egraph
+        enode = self.canonical(enode)
+        cid = self.hashcons.get(enode)
+        if cid!=None:
+            return self.find(cid)
+
+        cid = len(self.parent)
+        self.parent.append(cid)
+        self.classes[cid] = [enode]
+        self.hashcons[enode] = cid
+        self.size+=1
+
+        op,l,r = enode
+        if isinstance(op,node):
+            if type(op.val) in [int,float,complex]:
+                self.const[cid] = op.val
+        else:
+            value = _fold(op,self.const.get(l),self.const.get(r),l!=None,r!=None)
+            if value!=None:
+                self.union(cid,self.add_enode((node(value),None,None)))
+                cid = self.find(cid)
+        return cid
+
+    def add(self,root):
+        # Returns the class of the tree at root
+        classes = {}
+        stack = [root]
+        while stack:
+            a = stack[-1]
+            if a in classes:
+                stack.pop()
+                continue
+
+            # children are added before a
+            pending = [c for c in (a.left,a.right) if c is not None and c not in classes]
+            if pending:
+                stack.extend(pending)
+                continue
+            stack.pop()
+
+            if a.left is None and a.right is None:
+                classes[a] = self.add_enode((a,None,None))
+            else:
+                classes[a] = self.add_enode((a.val,classes.get(a.left),classes.get(a.right)))
+        return classes[root]
+
+    def union(self,a,b):
+        # Merges the classes of a and b, returns whether they were different classes
+        a,b = self.find(a),self.find(b)
+        if a==b:
+            return False
+        if len(self.classes[a])<len(self.classes[b]):
+            a,b = b,a
+        self.parent[b] = a
+        self.classes[a]+=self.classes.pop(b)
+        if b in self.const:
+            self.const.setdefault(a,self.const.pop(b))
+        return True
 
-    return tokenize_str
+    def rebuild(self):
+        # Restores the invariants after unions: e-nodes whose children are now equal are merged (congruence),
+        # operations on classes that became constants are folded and every e-node is written with the
+        # canonical ids of its children
+        changed = True
+        while changed:
+            changed = False
+            self.hashcons = {}
+            for cid in list(self.classes):
+                for enode in list(self.classes.get(cid,[])):
+                    enode = self.canonical(enode)
+                    other = self.hashcons.get(enode)
+                    if other!=None and self.find(other)!=self.find(cid):
+                        changed|= self.union(other,cid)
+                    self.hashcons[enode] = self.find(cid)
+
+                    op,l,r = enode
+                    if not isinstance(op,node) and self.find(cid) not in self.const:
+                        value = _fold(op,self.const.get(l),self.const.get(r),l!=None,r!=None)
+                        if value!=None:
+                            changed|= self.union(cid,self.add_enode((node(value),None,None)))
+
+        for cid in self.classes:
+            self.classes[cid] = list(dict.fromkeys(self.canonical(enode) for enode in self.classes[cid]))
+
+    def match(self,pattern,cid,subst):
+        # Yields every substitution that extends subst so the class cid contains pattern
+        # Patterns are '?name' for any class, (op,right) or (op,left,right) for operations and values for leaves
+        cid = self.find(cid)
+        if isinstance(pattern,str) and pattern[0]=='?':
+            if pattern not in subst:
+                yield {**subst,pattern:cid}
+            elif self.find(subst[pattern])==cid:
+                yield subst
+        elif isinstance(pattern,tuple):
+            for op,l,r in self.classes[cid]:
+                if op!=pattern[0]:
+                    continue
+                if len(pattern)==2:
+                    if l==None:
+                        yield from self.match(pattern[1],r,subst)
+                elif l!=None:
+                    for s in self.match(pattern[1],l,subst):
+                        yield from self.match(pattern[2],r,s)
+        elif isinstance(pattern,str):
+            for op,l,r in self.classes[cid]:
+                if isinstance(op,node) and op.val==pattern:
+                    yield subst
+                    return
+        elif self.const.get(cid)==pattern and type(self.const[cid])!=bool:
+            yield subst
+
+    def instantiate(self,pattern,subst):
+        # Returns the class of pattern with the classes of subst put in for its '?name' parts
+        if isinstance(pattern,str) and pattern[0]=='?':
+            return subst[pattern]
+        elif isinstance(pattern,tuple):
+            if len(pattern)==2:
+                return self.add_enode((pattern[0],None,self.instantiate(pattern[1],subst)))
+            return self.add_enode((pattern[0],self.instantiate(pattern[1],subst),self.instantiate(pattern[2],subst)))
+        return self.add_enode((node(pattern),None,None))
+
+    def saturate(self,rules,node_limit=10000,time_limit=1.0,iter_limit=30,root=None,patience=3):
+        # Applies rules until no rule adds anything new or a limit is reached
+        # rules are (pattern, result) or (pattern, result, condition(egraph,subst))
+        # With root it also stops when the cheapest tree of the class root has not improved for patience rounds
+        # Returns whether the egraph was saturated
+        end = time.perf_counter()+time_limit
+        cost,unchanged = None,0
+        for _ in range(iter_limit):
+            if self.size>=node_limit or time.perf_counter()>end:
+                return False
+
+            # every match is found before the egraph is changed
+            matches = []
+            with_op = {}    # operation -> classes with an e-node of the operation
+            for cid,enodes in self.classes.items():
+                for op in dict.fromkeys(op for op,l,r in enodes if not isinstance(op,node)):
+                    with_op.setdefault(op,[]).append(cid)
+
+            for rule in rules:
+                for cid in with_op.get(rule[0][0],[]):
+                    matches+=[(cid,rule[1],subst) for subst in self.match(rule[0],cid,{}) if len(rule)<3 or rule[2](self,subst)]
+                    if time.perf_counter()>end:
+                        break
+                else:
+                    continue
+                break
 
-def simplify(self,root):
-    pass
+            changed = False
+            for cid,result,subst in matches:
+                if self.size>=node_limit or time.perf_counter()>end:
+                    self.rebuild()
+                    return False
+                changed|= self.union(cid,self.instantiate(result,subst))
+            self.rebuild()
+            if not changed:
+                return True
+
+            if root!=None:
+                best = self.costs()[self.find(root)][0]
+                cost,unchanged = best,(unchanged+1 if best==cost else 0)
+                if unchanged>=patience:
+                    return False
+        return False
+
+    def costs(self):
+        # Returns class id -> ((operations,nodes),e-node) of the cheapest tree of every class
+        best = {}   # class id -> ((operations,nodes),e-node)
+        changed = True
+        while changed:
+            changed = False
+            for c,enodes in self.classes.items():
+                for enode in enodes:
+                    op,l,r = enode
+                    if isinstance(op,node):
+                        cost = (0,1)
+                    elif (l!=None and self.find(l) not in best) or (r!=None and self.find(r) not in best):
+                        continue
+                    else:
+                        children = [best[self.find(k)][0] for k in (l,r) if k!=None]
+                        cost = (1+sum(k[0] for k in children),1+sum(k[1] for k in children))
+                    if c not in best or cost<best[c][0]:
+                        best[c] = (cost,enode)
+                        changed = True
+        return best
+
+    def extract(self,cid):
+        # Returns the tree in class cid with the fewest operations, ties go to the fewest nodes
+        best = self.costs()
+
+        built = {}
+        def build(c):
+            # iterative so deep trees do not reach the recursion limit
+            stack = [self.find(c)]
+            while stack:
+                k = stack[-1]
+                if k in built:
+                    stack.pop()
+                    continue
+                op,l,r = best[k][1]
+                pending = [self.find(x) for x in (l,r) if x!=None and self.find(x) not in built]
+                if pending:
+                    stack.extend(pending)
+                    continue
+                stack.pop()
+                built[k] = op if isinstance(op,node) else node(op,
+                    None if l==None else built[self.find(l)],
+                    None if r==None else built[self.find(r)])
+            return built[self.find(c)]
+        return build(cid)
+
+def fold_constants(root,memo=None):
+    # Returns the tree with every subtree that has no variables replaced by a leaf of its value
+    # Symbols in _constants (pi, e, i) are constants, every other name is a variable. Subtrees whose value is
+    # None (1/0, 0^x, ...) are kept as they are so they evaluate the same way as before
+    # memo holds results of shared subtrees so each one is only folded once
+    if memo==None:
+        memo = {}
+
+    stack = [root]
+    while stack:
+        a = stack[-1]
+        if a in memo:
+            stack.pop()
+            continue
 
-def common_form(root):
+        # children are folded before a
+        pending = [c for c in (a.left,a.right) if c is not None and c not in memo]
+        if pending:
+            stack.extend(pending)
+            continue
+        stack.pop()
+
+        left,right = memo.get(a.left),memo.get(a.right)
+        folded = a if left is a.left and right is a.right else node(a.val,left,right)
+        if right is not None and _is_value(right) and (left is None or _is_value(left)):
+            if a.val in _single_operators and left is None:
+                value = _single_operators[a.val](_leaf_value(right))
+            elif a.val in _operators and left is not None:
+                value = _operators[a.val](_leaf_value(left),_leaf_value(right))
+            else:
+                value = None
+            if isinstance(value,np.generic):
+                value = value.item()
+            if type(value) in _value_types:
+                folded = node(value)
+        memo[a] = folded
+    return memo[root]
+
+def _is_value(root):
+    # whether the tree at root is a number or a symbol of _constants
+    return root.left is None and root.right is None and (type(root.val) in _value_types or
+        isinstance(root.val,str) and root.val in _constants)
+
+def _number(val):
+    # val as a python number, numpy scalars are converted and complex values without an imaginary part become real
+    # node vals must be one of _value_types to be evaluated
+    if isinstance(val,np.generic):
+        val = val.item()
+    if isinstance(val,complex) and val.imag==0:
+        val = val.real
+    return val
+
+def _leaf_value(root):
+    return _constants[root.val] if isinstance(root.val,str) else root.val
+
+def _fold(op,left,right,has_left,has_right):
+    # Value of op on constant operands, None if it is not folded
+    # Only arithmetic is folded and integers stay exact: 1/3 and 2^0.5 are kept as they are
+    if op not in ['+','-','*','/','^'] or not has_left or left==None or right==None:
+        return None
+    value = _operators[op](left,right)
+    if value==None or type(value) not in [int,float,complex]:
+        return None
+    if isinstance(left,int) and isinstance(right,int) and not isinstance(value,int):
+        return None
+    if not np.isfinite(value) or isinstance(left,bool) or isinstance(right,bool):
+        return None
+    return value
+
+def _not_zero(*names):
+    # condition of a rule: the classes of names are not the constant 0
+    return lambda graph,subst: all(graph.const.get(graph.find(subst[n]))!=0 for n in names)
+
+def _is_int(name):
+    # condition of a rule: the class of name is an integer constant
+    return lambda graph,subst: type(graph.const.get(graph.find(subst[name])))==int
+
+# Identities used by simplify: (pattern, result) or (pattern, result, condition)
+_simplify_rules = [
+    # rules of reduce
+    (('+','?a',0),'?a'),
+    (('-','?a',0),'?a'),
+    (('-',0,'?a'),('*',-1,'?a')),
+    (('*','?a',1),'?a'),
+    (('*','?a',0),0),
+    (('/','?a',1),'?a'),
+    (('/',0,'?a'),0,_not_zero('?a')),
+    (('exp',0),1),
+    (('^','?a',0),1,_not_zero('?a')),
+    (('^',1,'?a'),1),
+    (('^','?a',1),'?a'),
+    (('^','?a',-1),('/',1,'?a')),
+    (('^','e','?a'),('exp','?a')),
+    (('sin',0),0),
+    (('cos',0),1),
+    (('ln','e'),1),
+
+    # order and grouping of sums and products
+    (('+','?a','?b'),('+','?b','?a')),
+    (('*','?a','?b'),('*','?b','?a')),
+    (('+',('+','?a','?b'),'?c'),('+','?a',('+','?b','?c'))),
+    (('+','?a',('+','?b','?c')),('+',('+','?a','?b'),'?c')),
+    (('*',('*','?a','?b'),'?c'),('*','?a',('*','?b','?c'))),
+    (('*','?a',('*','?b','?c')),('*',('*','?a','?b'),'?c')),
+
+    # subtraction and division
+    (('-','?a','?b'),('+','?a',('*',-1,'?b'))),
+    (('+','?a',('*',-1,'?b')),('-','?a','?b')),
+    (('-','?a','?a'),0),
+    (('/','?a','?b'),('*','?a',('^','?b',-1))),
+    (('*','?a',('^','?b',-1)),('/','?a','?b')),
+    (('/','?a','?a'),1,_not_zero('?a')),
+
+    # distribution and factoring
+    (('*','?a',('+','?b','?c')),('+',('*','?a','?b'),('*','?a','?c'))),
+    (('+',('*','?a','?b'),('*','?a','?c')),('*','?a',('+','?b','?c'))),
+    (('+','?a','?a'),('*',2,'?a')),
+    (('+',('*','?n','?a'),'?a'),('*',('+','?n',1),'?a')),
+    (('+',('*','?n','?a'),('*','?m','?a')),('*',('+','?n','?m'),'?a')),
+
+    # powers
+    (('*','?a','?a'),('^','?a',2)),
+    (('*',('^','?a','?b'),'?a'),('^','?a',('+','?b',1))),
+    (('*',('^','?a','?b'),('^','?a','?c')),('^','?a',('+','?b','?c'))),
+    (('^',('^','?a','?b'),'?c'),('^','?a',('*','?b','?c')),_is_int('?c')),
+
+    # inverse functions, as in invert_branch
+    (('exp',('ln','?a')),'?a'),
+    (('ln',('exp','?a')),'?a'),
+    (('ln',('^','e','?a')),'?a'),
+    (('sin',('asin','?a')),'?a'),
+    (('cos',('acos','?a')),'?a'),
+    (('tan',('atan','?a')),'?a'),
+
+    # trigonometric, exponential and logarithmic identities
+    (('+',('^',('sin','?a'),2),('^',('cos','?a'),2)),1),
+    (('sin',('*',-1,'?a')),('*',-1,('sin','?a'))),
+    (('cos',('*',-1,'?a')),('cos','?a')),
+    (('/',('sin','?a'),('cos','?a')),('tan','?a')),
+    (('/',1,('cos','?a')),('sec','?a')),
+    (('/',1,('sin','?a')),('csc','?a')),
+    (('/',1,('tan','?a')),('cot','?a')),
+    (('*',('exp','?a'),('exp','?b')),('exp',('+','?a','?b'))),
+    (('+',('ln','?a'),('ln','?b')),('ln',('*','?a','?b'))),
+]
+
+def common_form(root,memo=None):
     # Returns the root of a tree whose form follows
     # a+b+c+...
     # where a,b,c,... are of the form
@@ -922,80 +1842,73 @@ def common_form(root):
     # where d,e,f,... are of the form
     # d^(g)
     # Where g is of common form
+    # Sums are kept as {product: coefficient} and products as {base: [powers]}. Nodes are interned so equal
+    # products and bases are the same key and like terms are combined in one pass over the terms
+    # memo holds the common forms of powers that were already worked out
+    if memo==None:
+        memo = {}
+    if root in memo:
+        return memo[root]
+    start = root
+
     root = _remove_minus_divide(root) # replace '-' with -1* and '/' with '^-1' to reduce sorting space
+    root = _combine_powers(root)    # before distribute so that a sum and its reciprocal cancel instead of being multiplied out
     root = distribute(root)
-    roots2sum = _summed_terms(root)   # splices expression to a list of summands
-
-    C = filter(lambda a:a!=None,[expr(root=term).evaluate() for term in roots2sum]) # Filter of summable terms
-    C = sum(C)                                                                      # constant values are grouped to C
-    roots2sum = [term for term in roots2sum if expr(root=term).evaluate()==None]    # Filter out terms that cannot be combined to C
-    final_roots2sum = []
-    if roots2sum==[]:       # returns C if it is the only term left
-        return node(C)
 
-    head_root = node('+')   # Instantiates the summation of terms
-    flyer = head_root       # flyer 'flies' to the right creating a '+' series
+    C = 0           # constant values are grouped to C
+    combined = {}   # product of a summand -> its coefficient, like terms are combined by adding coefficients
+    for summand in _summed_terms(root):
+        value = expr._evaluate_aux(summand,{})
+        if value!=None:
+            C+=value
+            continue
 
-    for summand in roots2sum:
-        products = _product_terms(summand)
-        
-        var_products = []
         coefficient = 1     # Coefficient of summand term
+        powers = {}         # base -> [powers] of the factors of the summand
+        for p in _product_terms(summand):
+            value = expr._evaluate_aux(p,{})
+            if value!=None:     # constant factors are combined into the coefficient
+                coefficient*=value
+                continue
+            if p.val=='exp':
+                p = node('^',node('e'),p.right)
+            elif p.val!='^':
+                p = node('^',p,node(1))
+            powers.setdefault(p.left,[]).append(p.right)
+
+        # bases whose exponents cancel (x*x^-1) are dropped, a product without bases is a constant
+        node_list = [node('^',base,common_form(_summation(exponents),memo)) for base,exponents in powers.items()]
+        node_list = [p for p in node_list if not (type(p.right.val) in [int,float,complex] and p.right.val==0)]
+        if node_list==[]:
+            C+=coefficient
+            continue
+        node_list.sort(key=_order_key)
+        product = _product(node_list)
 
-        for c in products:  # Filters out terms that can be combined into the coefficient
-            term = expr(root=c).evaluate()
-            if term!=None:
-                coefficient*=term
-            else:
-                var_products.append(c)
-        
-        var_products = [node('^',node('e'),n.right) if n.val=='exp' else n for n in var_products]   # replaces exp
-        var_products = [p if p.val=='^' else node('^',p,node(1)) for p in var_products]
+        if product in combined:
+            combined[product]+=coefficient
+        else:
+            combined[product] = coefficient
 
-        bases = [p.left for p in var_products]
-        powers = [p.right for p in var_products]
-        
-        unique_base_indexes = {}    # unique bases indexes and a [] of their powers
-
-        for i,base in enumerate(bases):
-            found = False
-            for ui in unique_base_indexes:
-                if equals(bases[ui],base):
-                    found = True
-                    unique_base_indexes[ui]+=[powers[i]]
-                    break
-            if not found:
-                unique_base_indexes[i]=[powers[i]]
-        
-        # node_list = [node(coefficient)]
-        node_list = []
-        for ui in unique_base_indexes:
-            power = _summation(unique_base_indexes[ui])
-            power = common_form(power)
-            node_list+=[node('^',bases[ui],power)]
-        
-        # indirect sort of node_list
-        str_node_list = np.array([_str_aux(r) for r in node_list])
-        i_sort = np.argsort(str_node_list)
-        node_list = [node_list[i] for i in i_sort]  # sorts node list
-        product = _product(node_list)
+    if combined=={}:        # returns C if it is the only term left
+        memo[start] = node(_number(C))
+        return memo[start]
 
-        combined = False
-        for p in final_roots2sum:
-            if equals(p.right,product):
-                p.left.val+=coefficient
-                combined = True
-                break
-        
-        if combined:
-            continue
+    final_roots2sum = [node('*',node(_number(coefficient)),product) for product,coefficient in combined.items()]
+    final_roots2sum.sort(key=_order_key)
+    temp = node('+',_summation(final_roots2sum),node(_number(C)))
+    memo[start] = reduce(temp)
+    return memo[start]
 
-        final_roots2sum+=[node('*',node(coefficient),product)]
+_order_keys = weakref.WeakKeyDictionary()   # node -> sort key, see _order_key
 
-    i_sort = np.argsort([_str_aux(n) for n in final_roots2sum])
-    final_roots2sum = [final_roots2sum[i] for i in i_sort]
-    temp = node('+',_summation(final_roots2sum),node(C))
-    return reduce(temp)
+def _order_key(root):
+    # Total order of the terms of common_form, trees are ordered by how they print
+    # Node hashes are identities that change between runs, so the printed form keeps the order stable
+    key = _order_keys.get(root)
+    if key==None:
+        key = _order_keys[root] = _str_aux(root)
+    return key
 
 def _str_aux(base,last_operator = None):
     # Auxillary equation of __str__
@@ -1028,19 +1941,52 @@ def _str_aux(base,last_operator = None):
     ]
     
     # Formats the tree to a string adding parhentesis to protect sub expressions as needed
+    # The tree is walked without recursion, strings holds the printed subtrees without the parentheses
+    # their parent adds so shared subtrees are printed once
+
+    def wrapped(a,operator):
+        # string of the subtree a under operator
+        if operator and a.val in op_order and op_order[a.val]<op_order[operator]:
+            return '('+strings[a]+')'
+        return strings[a]
+
+    strings = {}
+    stack = [base]
+    while stack:
+        a = stack[-1]
+        if a in strings:
+            stack.pop()
+            continue
 
-    if base.val in single_op:
-        return base.val+'('+_str_aux(base.right)+')'
-    elif isinstance(base.val,str) and base.left==None and base.right!=None: # Arbitrary functions
-        return base.val+'('+','.join(base.right.val)+')'
-
-    if base.val not in op_order:
-        return str(base.val)
-    
-    if last_operator and op_order[base.val]<op_order[last_operator]:
-        return '('+ _str_aux(base.left,base.val)+base.val+_str_aux(base.right,base.val)+')'
-
-    return _str_aux(base.left,base.val) + base.val + _str_aux(base.right,base.val)
+        if a.val in single_op:
+            children = [a.right]
+        elif isinstance(a.val,str) and a.left==None and a.right!=None or a.val not in op_order:
+            children = []
+        else:
+            children = [a.left,a.right]
+        pending = [c for c in children if c not in strings]
+        if pending:
+            stack.extend(pending)
+            continue
+        stack.pop()
+
+        if a.val in single_op:
+            strings[a] = a.val+'('+strings[a.right]+')'
+        elif isinstance(a.val,str) and a.left==None and a.right!=None: # Arbitrary functions
+            strings[a] = a.val+'('+','.join(a.right.val)+')'
+        elif a.val not in op_order:
+            strings[a] = str(a.val)
+        else:
+            left,right = wrapped(a.left,a.val),wrapped(a.right,a.val)
+
+            # operands of the same precedence that are not grouped the way they are read: a-(b+c), a/(b/c), (a^b)^c
+            if a.val in ['-','/'] and isinstance(a.right.val,str) and op_order.get(a.right.val)==op_order[a.val]:
+                right = '('+right+')'
+            elif a.val=='^' and a.left.val=='^':
+                left = '('+left+')'
+            strings[a] = left+a.val+right
+
+    return wrapped(base,last_operator)
 
 def _summation(node_list):
     # special cases of empty and len==1 lists
@@ -1049,15 +1995,10 @@ def _summation(node_list):
     elif len(node_list)==1:
         return node_list[0]
     
-    head = node('+')
-    head.left = node_list[0]
-    flyer = head
-    for n in node_list[1:-1]:
-        flyer.right = node('+')
-        flyer = flyer.right
-        flyer.left = n
-
-    flyer.right = node_list[-1]
+    # a+(b+(c+...)) built from the right
+    head = node_list[-1]
+    for n in reversed(node_list[:-1]):
+        head = node('+',n,head)
     
     return head
 
@@ -1069,206 +2010,352 @@ def _product(node_list):
     elif len(node_list)==1:
         return node_list[0]
 
-    head = node('*')
-    flyer = head
-    for n in node_list:
-        flyer.left = n
-        flyer.right = node('*')
-        flyer = flyer.right
-    flyer.val = 1
+    # a*(b*(c*(...*1))) built from the right
+    head = node(1)
+    for n in reversed(node_list):
+        head = node('*',n,head)
     return head
 
 def _summed_terms(root):
+    # summands of a+b+c+... from left to right
     if root==None:
         return []
-    if root.val!='+':
-        return [root]
-    return _summed_terms(root.left)+_summed_terms(root.right)
+    terms,stack = [],[root]
+    while stack:
+        a = stack.pop()
+        if a.val=='+':
+            stack+=[a.right,a.left]
+        else:
+            terms.append(a)
+    return terms
+
 def _product_terms(root):
-    if root.val!='*':
-        return [root]
-    return _product_terms(root.left)+_product_terms(root.right)
+    # factors of a*b*c*... from left to right
+    terms,stack = [],[root]
+    while stack:
+        a = stack.pop()
+        if a.val=='*':
+            stack+=[a.right,a.left]
+        else:
+            terms.append(a)
+    return terms
 
 def _copy(root):
+    # nodes are immutable and interned, so the copy is the node itself
     if root==None:
         return None
     return node(root.val,root.left,root.right)
 
-def _remove_minus_divide(root):
+def _var_paths(root):
+    # Returns a dict of 'variable' and [path] pairs for the tree at root, in the order of expr.dir
+    # A path is an int: a leading 1 followed by a bit for each step, 1 for left and 0 for right
+    # Arbitrary functions are indexed by name and their arguments are not searched
+    paths = {}
+    stack = [(root,1)]
+    while stack:
+        base,path = stack.pop()
+        if base.right is None and isinstance(base.val,str):
+            paths.setdefault(base.val,[]).append(path)
+        elif base.right is not None and isinstance(base.right.val,list):
+            paths.setdefault(base.val,[]).append(path)
+            continue
+        if base.right is not None:
+            stack.append((base.right,path<<1))
+        if base.left is not None:
+            stack.append((base.left,path<<1|1))
+    return paths
+
+def _decode_path(path):
+    # int encoded path of _var_paths -> list of 1/0
+    return [1 if c=='1' else 0 for c in bin(path)[3:]]
+
+def _join_paths(path,sub_path):
+    # int encoded path of sub_path followed from the end of path
+    n = sub_path.bit_length()-1
+    return path<<n | sub_path^(1<<n)
+
+def _path_order(path):
+    # sort key that orders int encoded paths like a left first walk of the tree
+    return bin(path)[3:].replace('0','2')
+
+def _set_paths(root,paths,sub):
+    # Returns the root of a tree where the nodes at the int encoded paths are replaced with sub
+    # Only the nodes along the paths are rebuilt, once each, every other subtree is shared with root
+    targets = set(paths)
+    along = set()   # paths of the nodes above the targets
+    for path in targets:
+        path>>=1
+        while path and path not in along:
+            along.add(path)
+            path>>=1
+
+    built = {}
+    stack = [(root,1)]
+    while stack:
+        base,path = stack[-1]
+        if path in targets:
+            built[path] = sub
+        elif path not in along:
+            built[path] = base
+        else:
+            # children are built before base
+            pending = [(c,p) for c,p in ((base.left,path<<1|1),(base.right,path<<1)) if c is not None and p not in built]
+            if pending:
+                stack.extend(pending)
+                continue
+            built[path] = node(base.val,built.get(path<<1|1),built.get(path<<1))
+        stack.pop()
+    return built[1]
+
+def _substitute(root,var,sub,memo=None):
+    # Returns the tree with every variable var replaced by the tree sub, root is not changed
+    # memo holds results of shared subtrees so each one is only rebuilt once
+    if root==None:
+        return None
+    if memo==None:
+        memo = {}
+    if root in memo:
+        return memo[root]
+
+    if root.val==var and root.right==None:
+        memo[root] = sub
+    elif root.left==None and root.right==None:
+        memo[root] = root
+    else:
+        memo[root] = node(root.val,_substitute(root.left,var,sub,memo),_substitute(root.right,var,sub,memo))
+    return memo[root]
+
+def _remove_minus_divide(root,memo=None):
     # Changes -(f)=> +(-1*f)
     # Changes /f => *f^(-1)
+    # memo holds results of shared subtrees so each one is only rebuilt once
     if root==None:
         return None
-
-    if root.val=='-':
-        root.val='+'
-        root.right = node(
-            '*',
-            node(-1),
-            root.right
-        )
-    if root.val=='/':
-        root.val='*'
-        root.right = node(
-            '^',
-            root.right,
-            node(-1)
-        )
-    
-    return node(root.val,_remove_minus_divide(root.left),_remove_minus_divide(root.right))
+    if memo==None:
+        memo = {}
+
+    def changed(a):
+        # a with its own operation changed, the children are changed after
+        if a.val=='-':
+            return '+',a.left,node('*',node(-1),a.right)
+        elif a.val=='/':
+            return '*',a.left,node('^',a.right,node(-1))
+        return a.val,a.left,a.right
+
+    stack = [root]
+    while stack:
+        a = stack[-1]
+        if a in memo:
+            stack.pop()
+            continue
+        val,left,right = changed(a)
+        pending = [c for c in (left,right) if c is not None and c not in memo]
+        if pending:
+            stack.extend(pending)
+            continue
+        stack.pop()
+        memo[a] = node(val,memo.get(left),memo.get(right))
+    return memo[root]
     
-def distribute(root):
+def _combine_powers(root,memo=None):
+    # Multiplies equal bases of products with number exponents: x*y*x^-2 => x^-1*y
+    # and multiplies out powers of powers with integer exponents: (x^2)^3 => x^6
+    # memo holds results of shared subtrees so each one is only rebuilt once
+    if memo==None:
+        memo = {}
+
+    def number(a):
+        return a is not None and a.left is None and a.right is None and type(a.val) in [int,float]
+
+    stack = [root]
+    while stack:
+        a = stack[-1]
+        if a in memo:
+            stack.pop()
+            continue
+        children = _product_terms(a) if a.val=='*' else [c for c in (a.left,a.right) if c is not None]
+        pending = [c for c in children if c not in memo]
+        if pending:
+            stack.extend(pending)
+            continue
+        stack.pop()
+
+        if a.val=='*':
+            exponents = {}  # base -> sum of its exponents, in the order the bases first occur
+            for f in (memo[c] for c in children):
+                base,exponent = (f.left,f.right.val) if f.val=='^' and number(f.right) and not number(f.left) else (f,1)
+                exponents[base] = exponents.get(base,0)+exponent
+            if len(exponents)==len(children):   # nothing to combine
+                if all(memo[c] is c for c in children):
+                    memo[a] = a
+                    continue
+                factors = [memo[c] for c in children]
+            else:
+                factors = [base if exponent==1 else node('^',base,node(exponent)) for base,exponent in exponents.items() if exponent!=0]
+            product = factors.pop() if factors else node(1)
+            for f in reversed(factors):
+                product = node('*',f,product)
+            memo[a] = product
+        else:
+            left,right = memo.get(a.left),memo.get(a.right)
+            if a.val=='^' and left.val=='^' and number(left.right) and number(right) and type(right.val)==int:
+                memo[a] = node('^',left.left,node(left.right.val*right.val))
+            else:
+                memo[a] = node(a.val,left,right)
+    return memo[root]
+
+def distribute(root,memo=None):
     # After a remove_minus_divide
     # expressions of the form a*(b+c)=> a*b+a*c
+    # memo holds results of shared subtrees so each one is only distributed once
     if root==None:
         return None
-    
-    if root.val=='*':
-        if root.right.val=='+':
-            root = node(
-                '+',
-                node('*',root.left,root.right.left),
-                node('*',root.left,root.right.right)
-            )
-        elif root.left.val=='+':
-            root= node(
-                '+',
-                node('*',root.right,root.left.left),
-                node('*',root.right,root.left.right)
-            )
-    return node(root.val,distribute(root.left),distribute(root.right))
+    if memo==None:
+        memo = {}
+
+    # children are distributed first, so sums that come out of a child are also multiplied out
+    stack = [root]
+    while stack:
+        a = stack[-1]
+        if a in memo:
+            stack.pop()
+            continue
+        pending = [c for c in (a.left,a.right) if c is not None and c not in memo]
+        if pending:
+            stack.extend(pending)
+            continue
+        stack.pop()
+
+        left,right = memo.get(a.left),memo.get(a.right)
+        if a.val=='*' and left.val=='+':
+            memo[a] = _summation([node('*',r,l) for r in _summed_terms(right) for l in _summed_terms(left)])
+        elif a.val=='*' and right.val=='+':
+            memo[a] = _summation([node('*',left,r) for r in _summed_terms(right)])
+        else:
+            memo[a] = node(a.val,left,right)
+    return memo[root]
 
 def equals(root1,root2):
-    if root1==None and root2==None:
-        return True
-    elif root1.val!=root2.val:
-        return False
-    
-    if equals(root1.left,root2.left) and equals(root1.right,root2.right):
-        return True
-    
-    return False
+    # nodes are interned so structurally equal trees are the same object
+    return root1 is root2
         
-def reduce(root):
-    if root.right==None and isinstance(root.val,str): #instances of variables 
-        return root
-    elif type(root.val) in [int,bool,complex,float]:
-        return root
-
-    right = reduce(root.right)
-    left = None
-    if root.left:
-        left = reduce(root.left)
-
-    if root.val=='+':
-        if left.val ==0:
-            return right
-        elif right.val == 0:
-            return left
-    elif root.val=='-':
-        if right.val==0:
-            return left
-        elif left.val==0:
-            return node('*',node(-1),right)
-    
-    elif root.val=='*':
-        e = str(expr(root=root))
-
-        if right.val==1:
-            return left
-        elif left.val==1:
-            return right
-        elif left.val==0 or right.val == 0:
-            return node(0)
+def reduce(root,memo=None):
+    # Simplifies the tree with _reduce_rules
+    # Subtrees are simplified from the bottom up and the rules are applied to each node until none applies,
+    # so one pass reaches a fixed point. A node whose subtrees did not change and where no rule applies is
+    # returned as it is. memo holds results of shared subtrees so each one is only simplified once
+    if memo==None:
+        memo = {}
+
+    stack = [root]
+    while stack:
+        a = stack[-1]
+        if a in memo:
+            stack.pop()
+            continue
 
-    elif root.val == '/':
-        if right.val==1:
-            return left
-        if left.val==0:
-            return left
-        pass
-    
-    elif root.val=='exp':
-        if right.val==0:
-            return node(1)
-        if right.val=='ln':
-            return right.right
-    
-    elif root.val=='ln':
-        if right.val=='e':
-            return node(1)
-        elif right.val=='^' and right.left.val=='e':
-            return right.right
-        elif right.val=='exp':
-            return right.right            
-
-    elif root.val=='^':
-        if right.val==0 and left.val!=0:
-            return node(0)
-        elif left.val== (0) and right.val==(0):
-            raise Exception('Invalid expression 0^0')
-        elif left.val==1:
-            return node(1)
-        elif right.val==1:
-            return left
-        elif right.val==-1:
-            return node('/',node(1),left)
-        elif left.val=='e':
-            return node('exp',right=right)
-    
-    elif root.val=='sin':
-        if right==0:
-            return right
-    elif root.val=='cos':
-        if right==0:
-            return node(1)
-    
-    return node(root.val,left,right)
-
-def next_operator(exp_list):
-    # Returns the index of the macro operation
-    # 'macro operation': if left and right components of the operation are grouped by parhentesis 
-    # it wouldn't change the expression. 'a $ b' = '(a) $ (b)', where a and b are 
-    # expressions and '$' is an operator
-    # ex. 
-    '''
-    >>> from axioms_2 import *
-    >>> next_operator('a+b*c')
-    1
-    '''
-    operator = [
-        '=',
-        '|',
-        '&',
-        '!',
-        '+',
-        '-',
-        '%',
-        '*',
-        '/',
-        '^',
-        '==',
-        '<',
-        '<=',
-        '>',
-        '>=',
-        'cos',
-        'sin',
-        'tan',
-        'sec',
-        'csc',
-        'cot',
-        'asin',
-        'acos',
-        'atan',
-        'ln']
+        # children are simplified before a
+        pending = [c for c in (a.left,a.right) if c is not None and c not in memo]
+        if pending:
+            stack.extend(pending)
+            continue
+        stack.pop()
 
-    for op in operator:
-        if op in exp_list:
-            if op=='^':
-                return exp_list.index('^')
-            return len(exp_list)-exp_list[::-1].index(op)-1
+        left,right = memo.get(a.left),memo.get(a.right)
+        reduced = a if left is a.left and right is a.right else node(a.val,left,right)
 
+        # rules are applied until none applies, results of rules are built from simplified subtrees
+        while reduced.left is not None or reduced.right is not None:
+            for applies,result in _reduce_rules.get(reduced.val,[]):
+                if applies(reduced.left,reduced.right):
+                    reduced = result(reduced.left,reduced.right)
+                    break
+            else:
+                break
+        memo[a] = reduced
+    return memo[root]
+
+def _invalid_zero_power(f,g):
+    raise Exception('Invalid expression 0^0')
+
+# Rules of reduce: operation -> [(applies(left,right), result(left,right))], the first rule that applies is used
+_reduce_rules = {
+    '+':[
+        (lambda f,g: f.val==0, lambda f,g: g),                          # 0+g => g
+        (lambda f,g: g.val==0, lambda f,g: f)],                         # f+0 => f
+    '-':[
+        (lambda f,g: g.val==0, lambda f,g: f),                          # f-0 => f
+        (lambda f,g: f.val==0, lambda f,g: node('*',node(-1),g))],      # 0-g => -1*g
+    '*':[
+        (lambda f,g: g.val==1, lambda f,g: f),                          # f*1 => f
+        (lambda f,g: f.val==1, lambda f,g: g),                          # 1*g => g
+        (lambda f,g: f.val==0 or g.val==0, lambda f,g: node(0))],       # 0*g, f*0 => 0
+    '/':[
+        (lambda f,g: g.val==1, lambda f,g: f),                          # f/1 => f
+        (lambda f,g: f.val==0, lambda f,g: f)],                         # 0/g => 0
+    'exp':[
+        (lambda f,g: g.val==0, lambda f,g: node(1)),                    # exp(0) => 1
+        (lambda f,g: g.val=='ln', lambda f,g: g.right)],                # exp(ln(g)) => g
+    'ln':[
+        (lambda f,g: g.val=='e', lambda f,g: node(1)),                  # ln(e) => 1
+        (lambda f,g: g.val=='^' and g.left.val=='e', lambda f,g: g.right), # ln(e^g) => g
+        (lambda f,g: g.val=='exp', lambda f,g: g.right)],               # ln(exp(g)) => g
+    '^':[
+        (lambda f,g: g.val==0 and f.val!=0, lambda f,g: node(1)),       # f^0 => 1
+        (lambda f,g: f.val==0 and g.val==0, _invalid_zero_power),
+        (lambda f,g: f.val==1, lambda f,g: node(1)),                    # 1^g => 1
+        (lambda f,g: g.val==1, lambda f,g: f),                          # f^1 => f
+        (lambda f,g: g.val==-1, lambda f,g: node('/',node(1),f)),       # f^-1 => 1/f
+        (lambda f,g: f.val=='e', lambda f,g: node('exp',right=g))],     # e^g => exp(g)
+    'sin':[
+        (lambda f,g: g.val==0, lambda f,g: g)],                         # sin(0) => 0
+    'cos':[
+        (lambda f,g: g.val==0, lambda f,g: node(1))],                   # cos(0) => 1
+}
+
+# Precedence of binary operators, lowest first. The lowest precedence operator of an expression is its root.
+# Function names that follow a value operate on the values to their left and right ('2sin(x)').
+_precedence = {op:i for i,op in enumerate([
+    '=',
+    '|',
+    '&',
+    '!',
+    '+',
+    '-',
+    '%',
+    '*',
+    '/',
+    '^',
+    '==',
+    '<',
+    '<=',
+    '>',
+    '>=',
+    'cos',
+    'sin',
+    'tan',
+    'sec',
+    'csc',
+    'cot',
+    'asin',
+    'acos',
+    'atan',
+    'ln'])}
+
+# Functions of one argument, sin(x) => node('sin',right=node('x'))
+_single_arg_operators = [
+    'sin',
+    'cos',
+    'tan',
+    'csc',
+    'sec',
+    'cot',
+    'asin',
+    'acos',
+    'atan',
+    '!',
+    'exp',
+    'ln']
 
 def integrate(root,var):
     # If a form is recognized that can directly be integrated return the integrated form of the expression
@@ -1300,15 +2387,847 @@ def integrate(root,var):
         pass
 
 
+class lru:
+    # A thread safe dictionary that holds at most maxsize items
+    # Once full, putting a new key evicts the least recently used item
+    def __init__(self,maxsize:int=1024):
+        self.maxsize = maxsize
+        self.hits = 0       # gets that found their key
+        self.misses = 0     # gets that did not
+        self.evictions = 0  # items dropped to stay within maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self,key,default=None):
+        # returns the item of key and marks it as most recently used
+        with self._lock:
+            try:
+                val = self._items[key]
+            except KeyError:
+                self.misses+=1
+                return default
+            self._items.move_to_end(key)
+            self.hits+=1
+            return val
+
+    def put(self,key,val):
+        with self._lock:
+            self._items[key] = val
+            self._items.move_to_end(key)
+            while len(self._items)>max(self.maxsize,0):
+                self._items.popitem(last=False)
+                self.evictions+=1
+
+    def clear(self):
+        # drops every item and resets the counters
+        with self._lock:
+            self._items.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def info(self)->dict:
+        return {'hits':self.hits,'misses':self.misses,'evictions':self.evictions,'size':len(self._items),'maxsize':self.maxsize}
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self,key):
+        return key in self._items
+
+
+class root_result:
+    # Outcome of expr.find_root
+    # root: the estimate of the root, function_value: the expression at root
+    # converged: whether the tolerance was met, iterations: steps taken, evaluations: calls of f and f'
+    # bracket: the last bracket around the root (None for unbracketed Newton), message: how it stopped
+    def __init__(self):
+        self.root = None
+        self.function_value = None
+        self.converged = False
+        self.iterations = 0
+        self.evaluations = 0
+        self.bracket = None
+        self.message = ''
+
+    def _done(self,root,function_value,converged,message):
+        self.root = float(root)
+        self.function_value = None if function_value==None else float(function_value)
+        self.converged = converged
+        self.message = message
+        return self
+
+    def __float__(self):
+        return float(self.root)
+
+    def __repr__(self):
+        return (f'root_result(root={self.root}, converged={self.converged}, iterations={self.iterations}, '
+                f'evaluations={self.evaluations}, message={self.message!r})')
+
+
+# Compiled (f, df/dvar) functions of equations keyed on (root, var, variables), see _solver_function
+_solver_cache = lru(256)
+
+def _solver_root(root):
+    # The tree whose roots are solutions of root, f=g => f-g
+    return node('-',root.left,root.right) if root.val=='=' else root
+
+def _solver_compiled(root,var,array=False):
+    # Returns (compiled,others) where compiled(var,*others) returns (f, df/dvar) of the expression
+    f = _solver_root(root)
+    others = tuple(v for v in _variables(f) if v!=var)
+    key = (f,var,others,array)
+    compiled = _solver_cache.get(key)
+    if compiled==None:
+        df = expr(root=f).pD(var).root
+        compiled = _compile_roots([f,df],(var,)+others,array)
+        _solver_cache.put(key,compiled)
+    return compiled,others
+
+def _solver_function(root,var,val_dict):
+    # Returns a function of var that returns (f, df/dvar) of the expression
+    # Variables other than var take their values from val_dict
+    compiled,others = _solver_compiled(root,var)
+    values = [val_dict.get(v) for v in others]
+    def function(x):
+        # values that overflow or are not finite are treated as undefined (None)
+        try:
+            with np.errstate(all='ignore'):
+                fx,dfx = compiled(x,*values)
+        except (OverflowError,ZeroDivisionError):
+            return None,None
+        if fx==None or isinstance(fx,complex) or not np.isfinite(fx):
+            return None,None
+        return fx,dfx if dfx!=None and not isinstance(dfx,complex) and np.isfinite(dfx) else None
+    return function
+
+def _real_values(y,shape):
+    # y broadcast to shape as floats for the solvers, complex values are NaN (not a real root)
+    y = np.broadcast_to(y,shape)
+    if np.iscomplexobj(y):
+        y = np.where(y.imag==0,y.real,np.nan)
+    return y.astype(float)
+
+def _search_bracket(root,var,x0,val_dict):
+    # Looks for the sign change closest to x0 on points spaced geometrically on both sides of x0
+    # Returns (a,b) or None
+    offsets = np.geomspace(1e-3,1e12,300)*max(1,abs(x0))
+    x = np.concatenate([x0-offsets[::-1],[x0],x0+offsets])
+    with np.errstate(all='ignore'):
+        y = _real_values(expr(root=_solver_root(root)).evaluate_array(val_dict={**val_dict,var:x}),x.shape)
+    signs = np.sign(y)
+    changes = np.nonzero((signs[:-1]*signs[1:]<=0)&~np.isnan(y[:-1])&~np.isnan(y[1:]))[0]
+    if len(changes)==0:
+        return None
+    i = changes[np.argmin(np.abs(x[changes]-x0))]
+    return (x[i],x[i+1])
+
+def _bracketed_root(f,a,b,fa,fb,x,tol,maxiter,result):
+    # Safeguarded Newton iteration inside the bracket [a,b] where fa and fb differ in sign
+    # Newton steps are only taken when they land inside the bracket and are at most half the step
+    # before them, otherwise an Illinois step is taken: regula falsi where the function value of an
+    # end that has been kept twice in a row is halved so the bracket shrinks from both sides
+    if x==None or not min(a,b)<x<max(a,b):
+        x = a-fa*(b-a)/(fb-fa)
+    side = 0            # 1/-1 when the last point replaced the a/b end, for the Illinois rule
+    step = abs(b-a)     # size of the last step, Newton steps have to at least halve it
+    widths = [abs(b-a)]*3   # bracket widths of the last iterations, the bracket is bisected when it shrinks too slowly
+    for result.iterations in range(1,maxiter+1):
+        fx,dfx = f(x)
+        result.evaluations+=1
+        if fx==None:
+            # undefined inside the bracket, tries other points of the bracket
+            for t in (0.5,0.382,0.618):
+                x = a+t*(b-a)
+                fx,dfx = f(x)
+                result.evaluations+=1
+                if fx!=None:
+                    break
+            else:
+                result.bracket = (a,b)
+                return result._done(x,None,False,'the expression cannot be evaluated inside the bracket')
+        if fx==0:
+            result.bracket = (x,x)
+            return result._done(x,fx,True,'exact root')
+
+        # Illinois rule, when the same end is replaced twice in a row the value of the other end is halved
+        if np.sign(fx)==np.sign(fa):
+            a,fa = x,fx
+            if side==1:
+                fb/=2
+            side = 1
+        else:
+            b,fb = x,fx
+            if side==-1:
+                fa/=2
+            side = -1
+        result.bracket = (a,b)
+
+        if abs(b-a)<=tol*(1+abs(x)):
+            return result._done(x,fx,True,'bracket converged')
+
+        widths = widths[1:]+[abs(b-a)]
+        newton = x-fx/dfx if dfx else None
+        if newton!=None and abs(newton-x)<=tol*(1+abs(x)):
+            return result._done(x,fx,True,'newton converged')
+        if newton!=None and min(a,b)<newton<max(a,b) and abs(newton-x)<=step/2:
+            new = newton
+        elif widths[-1]>widths[0]/2:
+            new = (a+b)/2
+        else:
+            new = a-fa*(b-a)/(fb-fa)
+            if not min(a,b)<new<max(a,b):
+                new = (a+b)/2
+        step = abs(new-x)
+        x = new
+        if step<=tol*(1+abs(x)):
+            fx,_ = f(x)
+            result.evaluations+=1
+            return result._done(x,fx,True,'step converged')
+
+    return result._done(x,fx,False,'maximum iterations reached')
+
+
+# Roots of parsed expression strings keyed on the string without spaces
+# Roots are immutable so every expr made from the same string shares one tree
+parse_cache = lru(4096)
+
+# Simplified derivatives keyed on (root, variable), see expr.pD
+derivative_cache = lru(1024)
+
+
 class node:
     # Units of expression objects
     # Describes the structure of mathematical expressions in with 
     # operations and left and right components
+    # Nodes are immutable and interned. Constructing a node with the same val, left and right as a
+    # living node returns that node, so structurally equal trees are the same object, they compare
+    # and hash by identity in constant time and equal subtrees are shared instead of copied
+    __slots__ = ('val','left','right','__weakref__')
+
+    _interned = weakref.WeakValueDictionary()   # (class, type of val, val, left, right) -> node
+    _lock = threading.Lock()
+
+    def __new__(cls,val,left:any= None,right:any = None):
+        # the type of val is part of the key so 1, 1.0 and True stay different nodes
+        key = (cls,type(val),tuple(val) if isinstance(val,list) else val,left,right)
+        with node._lock:
+            try:
+                n = node._interned.get(key)
+            except TypeError:   # unhashable vals are not interned
+                return cls._create(val,left,right)
+            if n is None:
+                n = cls._create(val,left,right)
+                node._interned[key] = n
+        return n
+
+    @classmethod
+    def _create(cls,val,left,right):
+        n = object.__new__(cls)
+        object.__setattr__(n,'val',val)
+        object.__setattr__(n,'left',left)
+        object.__setattr__(n,'right',right)
+        return n
+
+    def __setattr__(self,name,value):
+        raise AttributeError('nodes are immutable, build a new node instead')
+
+    def __reduce__(self):
+        return (type(self),(self.val,self.left,self.right))
+
+
+# Derivative rules shared by every storage of expressions
+# rule(a,f,g,df,dg,make) returns the derivative of the operation a with left operand f, right operand g
+# and their derivatives df and dg. Single argument functions operate on their right operand g.
+# make(val,left,right) builds a new node in whatever storage the rules are run on
+_d_rules = {                    # df/dx where f(x)
+    '+':lambda a,f,g,df,dg,make: make('+',df,dg),   # f+g => f'+g'
+    '-':lambda a,f,g,df,dg,make: make('-',df,dg),   # f-g => f'-g'
+    '*':lambda a,f,g,df,dg,make: make(              # f*g => f'g+fg'
+        '+',
+        make('*',df,g),
+        make('*',f,dg)),
+    '/':lambda a,f,g,df,dg,make: make(              # f/g => (g*f'-f*g')/(g^2)
+        '/',
+        make(
+            '-',
+            make('*',g,df),
+            make('*',f,dg)),
+        make('^',g,make(2))),
+    '^':lambda a,f,g,df,dg,make: make(              # f^g => ((g*f')/f+g'*ln(f))*f^g
+        '*',
+        make(
+            '+',
+            make('/',make('*',g,df),f),
+            make('*',dg,make('ln',right=f))),
+        a),
+    'sin':lambda a,f,g,df,dg,make: make(            # sin(g) => g'*cos(g)
+        '*',dg,make('cos',right=g)),
+    'cos':lambda a,f,g,df,dg,make: make(            # cos(g) => -1*g'*sin(g)
+        '*',
+        make('*',make(-1),dg),
+        make('sin',right=g)),
+    'tan':lambda a,f,g,df,dg,make: make(            # tan(g) => g'*sec(g)^2
+        '*',
+        dg,
+        make('^',make('sec',right=g),make(2))),
+    'csc':lambda a,f,g,df,dg,make: make(            # csc(g) => -1*g'*csc(g)*cot(g)
+        '*',
+        make(-1),
+        make(
+            '*',
+            dg,
+            make('*',make('csc',right=g),make('cot',right=g)))),
+    'sec':lambda a,f,g,df,dg,make: make(            # sec(g) => g'*sec(g)*tan(g)
+        '*',
+        dg,
+        make('*',make('sec',right=g),make('tan',right=g))),
+    'cot':lambda a,f,g,df,dg,make: make(            # cot(g) => -1*g'*csc(g)^2
+        '*',
+        make(-1),
+        make(
+            '*',
+            dg,
+            make('^',make('csc',right=g),make(2)))),
+    'asin':lambda a,f,g,df,dg,make: make(           # asin(g) => g'/(1-g^2)^(1/2)
+        '/',
+        dg,
+        make('^',make('-',make(1),make('^',g,make(2))),make(1/2))),
+    'acos':lambda a,f,g,df,dg,make: make(           # acos(g) => -1*g'/(1-g^2)^(1/2)
+        '/',
+        make('*',make(-1),dg),
+        make('^',make('-',make(1),make('^',g,make(2))),make(1/2))),
+    'atan':lambda a,f,g,df,dg,make: make(           # atan(g) => g'/(1+g^2)
+        '/',
+        dg,
+        make('+',make(1),make('^',g,make(2)))),
+    'exp':lambda a,f,g,df,dg,make: make('*',dg,a),  # exp(g) => g'*exp(g)
+    '=':lambda a,f,g,df,dg,make: make('=',df,dg),   # f=g => f'=g'
+    'ln':lambda a,f,g,df,dg,make: make('/',dg,g)    # ln(g) => g'/g
+}
+
+# Operation codes of array_tree
+# Operators that are not in the list are saved as len(_opcodes)+(index of the operator in the symbol table)
+_opcodes = ['const','symbol','=','+','-','*','/','^','&','|','%','>','<','>=','<=','==','!',
+            'sin','cos','tan','csc','sec','cot','asin','acos','atan','ln','exp']
+_opcode_index = {op:i for i,op in enumerate(_opcodes)}
+_CONST = 0
+_SYMBOL = 1
+
+# Operations used by array_tree.evaluate_array, they work elementwise on numpy arrays
+_array_operators = {**_operators,'/':_divide,'^':_power,'&':np.logical_and,'|':np.logical_or}
+_array_single_operators = {**_single_operators,'!':np.logical_not}
+
+# Layout of array_tree.to_bytes, integers are little endian:
+# header: magic, version, bytes per index (1, 2 or 4), unused, number of entries n, number of constants, number of symbols
+# ops, left, right: n signed integers each, of the smallest size that holds every index of the tree
+# the constants and the symbols, see _pack_str and _pack_const
+# The opcodes are those of _opcodes, a change to the table needs a new version. Version 1 wrote the
+# arrays as int32 with the table of operations after them, it is still read
+_serial_header = struct.Struct('<4sHBBIII')
+_serial_header_v1 = struct.Struct('<4sHHIII')
+_serial_magic = b'AXTR'
+_serial_version = 2
+_serial_types = {1:'b',2:'h',4:'i'}    # bytes per index -> array typecode
+
+def _pack_str(s):
+    data = s.encode()
+    return struct.pack('<I',len(data))+data
+
+def _unpack_str(buffer,offset):
+    (size,) = struct.unpack_from('<I',buffer,offset)
+    offset+=4
+    return bytes(buffer[offset:offset+size]).decode(),offset+size
+
+# The table of operations as written by version 1
+_serial_opcodes = b''.join(_pack_str(op) for op in _opcodes)
+
+def _pack_const(val):
+    # a type code followed by the value
+    if isinstance(val,(bool,np.bool_)):
+        return b'b'+struct.pack('<?',bool(val))
+    elif isinstance(val,(int,np.integer)):
+        val = int(val)
+        return b'i'+struct.pack('<q',val) if -2**63<=val<2**63 else b'I'+_pack_str(str(val))
+    elif isinstance(val,(float,np.floating)):
+        return b'f'+struct.pack('<d',val)
+    elif isinstance(val,(complex,np.complexfloating)):
+        return b'c'+struct.pack('<dd',val.real,val.imag)
+    elif isinstance(val,list):    # arguments of arbitrary functions
+        return b'l'+struct.pack('<I',len(val))+b''.join(_pack_str(str(v)) for v in val)
+    raise Exception(f'{val!r}: cannot be serialized')
+
+def _unpack_const(buffer,offset):
+    code = bytes(buffer[offset:offset+1])
+    offset+=1
+    if code==b'b':
+        return struct.unpack_from('<?',buffer,offset)[0],offset+1
+    elif code==b'i':
+        return struct.unpack_from('<q',buffer,offset)[0],offset+8
+    elif code==b'I':
+        s,offset = _unpack_str(buffer,offset)
+        return int(s),offset
+    elif code==b'f':
+        return struct.unpack_from('<d',buffer,offset)[0],offset+8
+    elif code==b'c':
+        real,imag = struct.unpack_from('<dd',buffer,offset)
+        return complex(real,imag),offset+16
+    elif code==b'l':
+        (size,) = struct.unpack_from('<I',buffer,offset)
+        offset+=4
+        val = []
+        for _ in range(size):
+            s,offset = _unpack_str(buffer,offset)
+            val.append(s)
+        return val,offset
+    raise Exception(f'{code!r}: unknown constant in serialized expression')
+
+def _swapped(view,typecode='i'):
+    # int32 array of little endian typecode integers on a big endian machine
+    a = array(typecode,bytes(view))
+    a.byteswap()
+    return array('i',a)
+
+def _translate_op(op,opcodes,symbols):
+    # opcode of a tree written with the table opcodes in the current table, other names become symbols
+    if op<len(opcodes) and op>=0:
+        name = opcodes[op]
+        if name in _opcode_index:
+            return _opcode_index[name]
+        symbols.append(name)
+        return len(_opcodes)+len(symbols)-1
+    elif op>=len(opcodes):
+        return op-len(opcodes)+len(_opcodes)
+    return op
+
+def _key(op,left,right):
+    # packs an entry of an array_tree into one int, ints are cheaper to hash and store than tuples
+    return (op<<64)|((left+1)<<32)|(right+1)
+
+class array_tree:
+    # Compact storage of an expression tree for very large expressions
+    # Nodes are entries of the parallel arrays ops, left and right ordered so that children come
+    # before their parents, the root is the last entry. Shared subtrees are stored once.
+    # Leaves keep the index of their val in consts (numbers, argument lists) or symbols (variables) in left
+    # Operations keep the indexes of their children in left and right, -1 for no child
+    # view() gives node like objects for code that walks trees with .val, .left and .right
+    '''
+    >>> t = array_tree.from_node(expr('x^2+3*x').root)
+    >>> len(t)
+    6
+    >>> print(t)
+    x^2+3*x
+    >>> t.evaluate(val_dict={'x':2})
+    10
+    '''
+    __slots__ = ('ops','left','right','consts','symbols','_keys','_const_keys','_symbol_keys')
+
+    def __init__(self):
+        self.ops = array('i')
+        self.left = array('i')
+        self.right = array('i')
+        self.consts = []
+        self.symbols = []
+
+        # indexes used to share entries when nodes are added
+        # they are dropped by _release() once a tree is built and rebuilt if more nodes are added
+        self._keys = {}         # _key(op,left,right) -> index
+        self._const_keys = {}   # (type of val,val) -> index in consts
+        self._symbol_keys = {}  # symbol -> index in symbols
+
+    @classmethod
+    def from_node(cls,root):
+        # Builds an array_tree from a tree of nodes without recursion
+        tree = cls()
+        indexes = {}    # node -> index of node in tree
+        stack = [(root,False)]
+        while stack:
+            base,visited = stack.pop()
+            if base in indexes:
+                continue
+            children = [c for c in [base.left,base.right] if c!=None]
+            if children and not visited:
+                stack.append((base,True))
+                stack += [(c,False) for c in children]
+                continue
+            indexes[base] = tree.make(
+                base.val,
+                indexes[base.left] if base.left!=None else None,
+                indexes[base.right] if base.right!=None else None)
+        tree._release()
+        return tree
+
+    def to_node(self,i:int=None):
+        # Rebuilds the tree of nodes with root at index i (by default the root of the tree)
+        i = self.root if i==None else i
+        nodes = {}
+        for j in range(i+1):
+            op,l,r = self.ops[j],self.left[j],self.right[j]
+            if op==_CONST or op==_SYMBOL:
+                nodes[j] = node(self.val(j))
+            else:
+                nodes[j] = node(self.val(j),nodes[l] if l>=0 else None,nodes[r] if r>=0 else None)
+        return nodes[i]
+
+    def to_expr(self):
+        return expr(root=self.to_node())
+
+    def make(self,val,left:int=None,right:int=None):
+        # Adds a node and returns its index, an existing index is returned if the node is already stored
+        if self._keys==None:
+            self._reindex()
+        left = -1 if left==None else left
+        right = -1 if right==None else right
+
+        if left<0 and right<0:  # leaves
+            if isinstance(val,str):
+                op = _SYMBOL
+                left = self._symbol(val)
+            else:
+                op = _CONST
+                key = (type(val),tuple(val) if isinstance(val,list) else val)
+                try:
+                    if key not in self._const_keys:
+                        self._const_keys[key] = len(self.consts)
+                        self.consts.append(val)
+                    left = self._const_keys[key]
+                except TypeError:   # unhashable vals are not shared
+                    self.consts.append(val)
+                    left = len(self.consts)-1
+        elif isinstance(val,str):
+            op = _opcode_index[val] if val in _opcode_index else len(_opcodes)+self._symbol(val)
+        else:
+            self.consts.append(val)
+            op = -1-(len(self.consts)-1)
+
+        key = _key(op,left,right)
+        if key in self._keys:
+            return self._keys[key]
+        self.ops.append(op)
+        self.left.append(left)
+        self.right.append(right)
+        self._keys[key] = len(self.ops)-1
+        return len(self.ops)-1
+
+    def _release(self):
+        # Drops the indexes used while building, they take more memory than the arrays
+        self._keys = None
+        self._const_keys = None
+        self._symbol_keys = None
+
+    def _reindex(self):
+        # arrays read by from_bytes are views of the buffer, they are copied before the tree can grow
+        self.ops,self.left,self.right = [a if isinstance(a,array) else array('i',a) for a in (self.ops,self.left,self.right)]
+        self._keys = {_key(self.ops[i],self.left[i],self.right[i]):i for i in range(len(self.ops))}
+        self._symbol_keys = {s:i for i,s in enumerate(self.symbols)}
+        self._const_keys = {}
+        for i,val in enumerate(self.consts):
+            try:
+                self._const_keys.setdefault((type(val),tuple(val) if isinstance(val,list) else val),i)
+            except TypeError:
+                pass
+
+    def _symbol(self,s):
+        if s not in self._symbol_keys:
+            self._symbol_keys[s] = len(self.symbols)
+            self.symbols.append(s)
+        return self._symbol_keys[s]
+
+    def to_bytes(self)->bytes:
+        # Serializes the tree, see _serial_header for the layout
+        # Indexes are written as int8 or int16 when the tree is small enough, so small trees stay small
+        consts = b''.join(_pack_const(val) for val in self.consts)
+        symbols = b''.join(_pack_str(s) for s in self.symbols)
+        arrays = (self.ops,self.left,self.right)
+        low = min((min(a) for a in arrays if len(a)),default=0)
+        high = max((max(a) for a in arrays if len(a)),default=0)
+        width = next(w for w in (1,2,4) if -2**(8*w-1)<=low and high<2**(8*w-1))
+        arrays = [array(_serial_types[width],a) for a in arrays]
+        if sys.byteorder!='little':
+            for a in arrays:
+                a.byteswap()
+        header = _serial_header.pack(_serial_magic,_serial_version,width,0,len(self.ops),len(self.consts),len(self.symbols))
+        return b''.join([header]+[a.tobytes() for a in arrays]+[consts,symbols])
+
+    @classmethod
+    def from_bytes(cls,data):
+        # Reads a tree written by to_bytes from bytes or any buffer (mmap.mmap of a file for example)
+        # On little endian machines the arrays are views of the buffer and are not copied or read until they are used
+        buffer = memoryview(data)
+        if len(buffer)<_serial_header.size:
+            raise Exception('Not a serialized expression')
+        magic,version = struct.unpack_from('<4sH',buffer,0)
+        if magic!=_serial_magic:
+            raise Exception('Not a serialized expression')
+        if version==_serial_version:
+            _,_,width,_,n,n_consts,n_symbols = _serial_header.unpack_from(buffer,0)
+            offset = _serial_header.size
+            n_opcodes = None
+        elif version==1:
+            _,_,n_opcodes,n,n_consts,n_symbols = _serial_header_v1.unpack_from(buffer,0)
+            offset = _serial_header_v1.size
+            width = 4
+        else:
+            raise Exception(f'Serialized expression version {version} is not supported')
+        if width not in _serial_types:
+            raise Exception(f'Serialized expression has indexes of {width} bytes')
+
+        tree = cls()
+        arrays = []
+        for _ in range(3):
+            view = buffer[offset:offset+width*n]
+            arrays.append(view.cast(_serial_types[width]) if sys.byteorder=='little' else _swapped(view,_serial_types[width]))
+            offset+=width*n
+        tree.ops,tree.left,tree.right = arrays
+
+        opcodes = _opcodes
+        if n_opcodes==None:     # the table of the version, it is not written
+            pass
+        elif n_opcodes!=len(_opcodes) or buffer[offset:offset+len(_serial_opcodes)]!=_serial_opcodes:
+            opcodes = []
+            for _ in range(n_opcodes):
+                op,offset = _unpack_str(buffer,offset)
+                opcodes.append(op)
+        else:   # version 1 with the same table, it is skipped over
+            offset+=len(_serial_opcodes)
+        for _ in range(n_consts):
+            val,offset = _unpack_const(buffer,offset)
+            tree.consts.append(val)
+        for _ in range(n_symbols):
+            s,offset = _unpack_str(buffer,offset)
+            tree.symbols.append(s)
+
+        if opcodes!=_opcodes:   # written with another table of operations, opcodes are translated
+            tree.ops = array('i',[_translate_op(op,opcodes,tree.symbols) for op in tree.ops])
+        tree._release()
+        return tree
+
+    @property
+    def root(self):
+        return len(self.ops)-1
+
+    def __len__(self):
+        return len(self.ops)
+
+    def nbytes(self):
+        # Approximate memory used by the tree in bytes
+        arrays = sum(a.itemsize*len(a)+64 for a in [self.ops,self.left,self.right])
+        pools = sum(sys.getsizeof(v) for v in self.consts+self.symbols)
+        return arrays+pools
+
+    def val(self,i:int):
+        op = self.ops[i]
+        if op==_CONST:
+            return self.consts[self.left[i]]
+        elif op==_SYMBOL:
+            return self.symbols[self.left[i]]
+        elif op<0:
+            return self.consts[-1-op]
+        elif op<len(_opcodes):
+            return _opcodes[op]
+        return self.symbols[op-len(_opcodes)]
+
+    def view(self,i:int=None):
+        # node like view of the entry i
+        return _array_node(self,self.root if i==None else i)
 
-    def __init__(self,val,left:any= None,right:any = None):
-        self.val = val
-        self.right = right
-        self.left = left
+    def __str__(self):
+        return _str_aux(self.view())
+
+    def map(self):
+        # Returns a dict of 'variable' and [path] pairs in the same form as expr.dir
+        dir = {}
+        stack = [(self.root,[])]
+        while stack:
+            i,path = stack.pop()
+            op,l,r = self.ops[i],self.left[i],self.right[i]
+            if op==_SYMBOL:
+                dir.setdefault(self.symbols[l],[]).append(path)
+            elif r>=0 and self.ops[r]==_CONST and isinstance(self.consts[self.left[r]],list): # arbitrary function
+                dir.setdefault(self.val(i),[]).append(path)
+            elif op!=_CONST:
+                if r>=0:
+                    stack.append((r,path+[0]))
+                if l>=0:
+                    stack.append((l,path+[1]))
+        return dir
+
+    def evaluate(self,val_dict:dict={}):
+        # Evaluates every entry in order without recursion, same results as expr.evaluate
+        return self._evaluate(val_dict,None,_operators,_single_operators,_assign)
+
+    def evaluate_array(self,val_dict:dict={}):
+        # Elementwise evaluation over numpy arrays, same results as expr.evaluate_array
+        result = self._evaluate(val_dict,np.nan,_array_operators,_array_single_operators,_assign_array)
+        shape = np.broadcast_shapes(*[np.shape(val) for val in val_dict.values()])
+        return np.array(np.broadcast_to(result,np.broadcast_shapes(np.shape(result),shape)))
+
+    def _evaluate(self,val_dict,missing,operators,single_operators,assign):
+        # Walks the entries from the root like expr._evaluate_aux, the left side of an operation is
+        # only evaluated when the right side has a value
+        if len(self.ops)==0:
+            return missing
+        values = [_unset]*len(self.ops)
+        stack = [len(self.ops)-1]
+        while stack:
+            i = stack[-1]
+            if values[i] is not _unset:
+                stack.pop()
+                continue
+            op,l,r = self.ops[i],self.left[i],self.right[i]
+            if op==_CONST:
+                val = self.consts[l]
+                values[i] = val if type(val) in _value_types else missing
+                continue
+            elif op==_SYMBOL:
+                s = self.symbols[l]
+                values[i] = _constants[s] if s in _constants else val_dict.get(s,missing)
+                continue
+
+            if r>=0 and values[r] is _unset:
+                stack.append(r)
+                continue
+            val = self.val(i)
+            right = values[r] if r>=0 else missing
+            if l>=0 and values[l] is _unset and (val=='=' or right is not None and val in operators):
+                stack.append(l)
+                continue
+
+            stack.pop()
+            if val=='=':
+                values[i] = assign(values[l] if l>=0 else missing,right)
+            elif right is None or r<0:
+                values[i] = missing
+            elif val in single_operators:
+                values[i] = single_operators[val](right)
+            elif val in operators and l>=0 and values[l] is not None:
+                values[i] = operators[val](values[l],right)
+            else:
+                values[i] = missing
+        return values[-1]
+
+    def pD(self,var:str):
+        # Partial derivative computed directly on the arrays
+        # Every entry is differentiated once in order, so shared subtrees are only differentiated once
+        # and the result shares subtrees with the expression
+        tree = array_tree()
+        copy = []   # index in self -> index in tree, tree is a copy of self that the derivative is added to
+        for i in range(len(self.ops)):
+            op,l,r = self.ops[i],self.left[i],self.right[i]
+            if op==_CONST or op==_SYMBOL:
+                copy.append(tree.make(self.val(i)))
+            else:
+                copy.append(tree.make(self.val(i),copy[l] if l>=0 else None,copy[r] if r>=0 else None))
+
+        make = tree._make_reduced
+        d = []
+        for i in range(len(self.ops)):
+            op,l,r = self.ops[i],self.left[i],self.right[i]
+            val = self.val(i)
+            if val==var:
+                d.append(make(1))
+            elif op==_CONST or op==_SYMBOL:
+                d.append(make(0))
+            elif val=='^' and tree._const_val(d[r])==0:   # constant powers f^g => g*f^(g-1)*f'
+                g = tree._const_val(copy[r])
+                power = make(g-1) if g!=None else make('-',copy[r],make(1))
+                d.append(make('*',make('*',copy[r],make('^',copy[l],power)),d[l]))
+            elif val in _d_rules:
+                d.append(_d_rules[val](
+                    copy[i],
+                    copy[l] if l>=0 else None,
+                    copy[r] if r>=0 else None,
+                    d[l] if l>=0 else None,
+                    d[r] if r>=0 else None,
+                    make))
+            else:
+                raise Exception(f'Derivative of {val} is not defined')
+        return tree._compact(d[-1])
+
+    def _make_reduced(self,val,left:int=None,right:int=None):
+        # make() that drops identities such as 0+f, 1*f and 0*f while a derivative is built
+        lv = self._const_val(left)
+        rv = self._const_val(right)
+        if val=='+':
+            if lv==0:
+                return right
+            if rv==0:
+                return left
+        elif val=='-' and rv==0:
+            return left
+        elif val=='*':
+            if lv==0 or rv==0:
+                return self.make(0)
+            if lv==1:
+                return right
+            if rv==1:
+                return left
+        elif val=='/':
+            if lv==0:
+                return left
+            if rv==1:
+                return left
+        elif val=='^':
+            if rv==0 and lv!=0:     # f^0 => 1 like _reduce_rules, 0^0 is kept
+                return self.make(1)
+            if rv==1:
+                return left
+        return self.make(val,left,right)
+
+    def _const_val(self,i):
+        if i==None or self.ops[i]!=_CONST:
+            return None
+        val = self.consts[self.left[i]]
+        return val if type(val) in [int,float,complex] else None
+
+    def _compact(self,root:int):
+        # Returns a new array_tree of the entries reachable from root
+        reachable = set([root])
+        for i in range(root,-1,-1):
+            if i in reachable and self.ops[i]!=_CONST and self.ops[i]!=_SYMBOL:
+                reachable.update(c for c in [self.left[i],self.right[i]] if c>=0)
+
+        tree = array_tree()
+        new = {}
+        for i in sorted(reachable):
+            op,l,r = self.ops[i],self.left[i],self.right[i]
+            if op==_CONST or op==_SYMBOL:
+                new[i] = tree.make(self.val(i))
+            else:
+                new[i] = tree.make(self.val(i),new[l] if l>=0 else None,new[r] if r>=0 else None)
+        tree._release()
+        return tree
+
+class _array_node:
+    # node like view of an entry in an array_tree
+    __slots__ = ('tree','i')
+
+    def __init__(self,tree,i):
+        self.tree = tree
+        self.i = i
+
+    # views of the same entry are equal so they can be keys of the dicts of tree walks
+    def __eq__(self,other):
+        return isinstance(other,_array_node) and self.tree is other.tree and self.i==other.i
+
+    def __hash__(self):
+        return hash((id(self.tree),self.i))
+
+    @property
+    def val(self):
+        return self.tree.val(self.i)
+
+    @property
+    def left(self):
+        op,l = self.tree.ops[self.i],self.tree.left[self.i]
+        if op==_CONST or op==_SYMBOL or l<0:
+            return None
+        return _array_node(self.tree,l)
+
+    @property
+    def right(self):
+        op,r = self.tree.ops[self.i],self.tree.right[self.i]
+        if op==_CONST or op==_SYMBOL or r<0:
+            return None
+        return _array_node(self.tree,r)
 
 
 if __name__=="__main__":
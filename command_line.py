@@ -1,18 +1,82 @@
 from axioms_2 import expr as ExpBase
-from axioms_2 import node
-from queue import Queue
+from axioms_2 import node, array_tree, derivative_cache
+from queue import Queue, Empty
 import threading
+import codecs
+import struct
+import mmap
+import os
 from textwrap import dedent, indent
 import string
+import re
+import sys
+import time
+import argparse
+import asyncio
 import assistant
 
 class LengthError(Exception):
     '''
-    Raised when there the text in the input/output queues are not exactly 1
-    character long
+    Raised when the terminal puts an empty string in the input queue
     '''
     def __str__(self):
-        return 'LengthError: the terminal sent a string with a size other than 1'
+        return 'LengthError: the terminal sent an empty string'
+
+class OutputStream:
+    '''
+    buffer between the output functions of State and the front end. text is
+    written and read  in chunks rather than  one character at a  time, so the
+    lock is taken once per write and once  per drain no matter how much text
+    there is.
+
+    get_nowait()  and  get()  keep  the  names  of  Queue,  but  they return
+    everything which has been written since the last read as one string.
+    '''
+    def __init__(self):
+        self._chunks = []
+        self._ready = threading.Condition()
+
+    def put(self, chunk: str):
+        '''appends a chunk of text to the stream'''
+        if chunk == '':
+            return
+
+        with self._ready:
+            self._chunks.append(chunk)
+            self._ready.notify_all()
+
+    def drain(self) -> str:
+        '''returns all the text in the stream (\'\' if there is none)'''
+        with self._ready:
+            chunks = self._chunks
+            self._chunks = []
+        return ''.join(chunks)
+
+    def get_nowait(self) -> str:
+        '''like drain, but raises queue.Empty when there is nothing to read'''
+        text = self.drain()
+        if text == '':
+            raise Empty
+        return text
+
+    def get(self, block: bool = True, timeout: float = None) -> str:
+        '''like drain, but waits until there is something to read'''
+        if not block:
+            return self.get_nowait()
+
+        with self._ready:
+            if not self._ready.wait_for(lambda: self._chunks, timeout):
+                raise Empty
+        return self.get_nowait()
+
+    def empty(self) -> bool:
+        return len(self._chunks) == 0
+
+    def __len__(self):
+        '''number of characters waiting to be read'''
+        with self._ready:
+            return sum(len(chunk) for chunk in self._chunks)
+
 
 class State:
     '''
@@ -29,7 +93,8 @@ class State:
     example).
 
     the output functions (put, putln) treat the display device on the end of the
-    ostream as if it were a terminal in raw mode.
+    ostream as if it were a terminal in raw mode. ostream is an OutputStream, so
+    a front end can read all the pending output at once with ostream.drain().
 
     the  input  functions  get  and  getline perform  line  discipline  for  the
     processes.  if a  process wants  a different  line discipline  (canonical is
@@ -41,7 +106,11 @@ class State:
         self.exit_prog = False
 
         self.istream = Queue()
-        self.ostream = Queue()
+        self.ostream = OutputStream()
+        self._pending = '' # input which was read from istream but not used yet
+        self._skip_lf = False # the last line ended in CR, so a LF which follows it is skipped
+        self.echo = True # getline echoes input, programmatic clients can turn this off
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace') # for bytes sent to put
 
         # process which will be called
         self.fg_proc = cmd_line([], self)
@@ -49,44 +118,88 @@ class State:
         self.command_history = [] # list of commands which were entered by the user.
         self.command_history_index = 0 # this is the current place in the command history
 
+        self.journal = None # Journal which records changes to expressions (see save/load)
+        self.errors = 0 # number of errors reported by commands
+
+    def bind(self, name: str, expression):
+        '''
+        binds an expression to a name in the workspace. if a journal is open the
+        binding is appended to it.
+        '''
+        self.expressions[name] = expression
+
+        if self.journal != None:
+            self.journal.append(name, expression)
+
     def push_cmd(self, cmd:str):
         self.command_history.append(cmd)
         self.command_history_index = len(self.command_history) # processing a command resets the history index to the end
 
-    def put(self, s: str):
+    # every line break is sent to the terminal as CR LF
+    newlines = str.maketrans({'\r': '\r\n', '\n': '\r\n'})
+
+    def put(self, s):
         '''
-        sends a string down the output pipe.
+        sends a string (or utf-8 bytes) down the output pipe as one chunk.
 
         front-end implementations may want to  override this method to send some
         kind of  signal to update  their display buffer. otherwise,  the ostream
         needs to be polled.
         '''
-        for c in s:
-            if c in '\r\n':
-                self.ostream.put('\r\n')
-            else:
-                self.ostream.put(c)
+        if isinstance(s, (bytes, bytearray, memoryview)):
+            s = self._decoder.decode(bytes(s))
+
+        self.ostream.put(s.translate(self.newlines))
 
     def putln(self, s: str = None):
         '''like put, but adds a newline to the end.'''
         if s == None:
-            self.ostream.put('\r\n')
-            return
+            s = ''
 
-        self.put(s)
-        self.ostream.put('\r\n')
+        if isinstance(s, (bytes, bytearray, memoryview)):
+            s = self._decoder.decode(bytes(s))
+
+        self.put(s + '\n')
 
     def get(self):
         '''
         reads  a character  from the  input  \'stream\'. Blocks  until there  is
         something in the queue.
+
+        the front end may put more than one character at a time in the  queue,
+        the characters which are not read are kept for the next get/getline.
         '''
-        c = self.istream.get()
+        chunk = self._chunk()
+        self._pending = chunk[1:]
+        return chunk[0]
+
+    def _chunk(self) -> str:
+        '''the next chunk of input, or what is left of the last one'''
+        chunk = self._pending
+        self._pending = ''
+        while chunk == '':
+            chunk = self.istream.get()
+            if len(chunk) == 0:
+                raise LengthError
+        return chunk
 
-        if len(c) != 1:
-            raise LengthError
+    def error(self, s: str):
+        '''like putln, but for error messages. counts the errors in self.errors'''
+        self.errors += 1
+        self.putln(s)
 
-        return c
+    def escape_sequence(self, code: str):
+        '''
+        called by getline for every escape sequence the user types (ie. \'\\033[D\'
+        for the left arrow). escape sequences are ignored by default.
+        '''
+        pass
+
+    # characters which need more than appending to the line
+    line_controls = re.compile('[\r\n\177\010\033]')
+
+    # cursor drawn at the end of the line by getline
+    block = '█'
 
     def getline(self):
         '''
@@ -94,70 +207,232 @@ class State:
         in the queue.
 
         this functions performs  the line editing operations that  you would see
-        from a tty driver (ie backspace, echoing the character, etc.)
-        '''
-        block = '█'
-        line = ''
+        from a tty driver (ie backspace, echoing the character, etc.) the front end
+        may put whole chunks of text (ie. a paste)  in the queue, each chunk is
+        edited in one pass and echoed with one put. if echo is False nothing is
+        echoed.
 
-        line_pos = 0
-        final_set = string.ascii_letters + '@[]\\^_`{}|~'
-        escape_seq = False
+        CR LF ends one line, not two. escape sequences are passed to
+        escape_sequence().
+        '''
+        line = []
+        done = False
         escape_code = ''
 
-        while True:
-            self.put(block + '\010')
-
-            # get and validate a character
-            c = self.istream.get()
-            if len(c) != 1:
-                raise LengthError
-
-            # process the escape code (but don't print it)
-            while escape_seq:
-                escape_code += c
-                if c in final_set:
-                    self.escape_sequence(escape_code)
-                    escape_seq = False
-
-                c = self.istream.get()
+        if self.echo:
+            self.put(self.block + '\010')
 
-            # handle escape codes (if applicable)
-            if escape_code.strip(' ') == '\033[D': # left arrow
-                if line_pos > 0:
-                    # uninvert current character
-                    self.put('\033[27m' + line[line_pos-1])
+        while not done:
+            done, escape_code = self._edit(line, self._chunk(), escape_code)
 
-                    # invert previous character
-                    self.put('\033[2D\033[7m' + line[line_pos-2])
+        return ''.join(line)
 
-                    line_pos -= 1
-            if escape_code.strip(' ') == '\033[C': # right arrow
-                if line_pos < len(line):
-                    # uninvert current character
-                    self.put('\033[27m' + line[line_pos-1])
+    def _edit(self, line: list, chunk: str, escape_code: str) -> (bool, str):
+        '''
+        line discipline of getline for one chunk of input. the text is added to
+        line (a list of strings) and the chunk is echoed. escape_code is the
+        unfinished escape sequence from the last chunk.
 
-                    # invert next character
-                    self.put('\033[2C\033[7m' + line[line_pos])
+        returns whether the line ended and the unfinished escape sequence. the
+        input after the end of the line is kept for the next read.
+        '''
+        block = self.block
+        done = False
+
+        # the LF of a CR LF split between two chunks
+        if self._skip_lf and chunk[0] == '\n':
+            chunk = chunk[1:]
+        self._skip_lf = False
+
+        echo = []
+        i = 0
+        while i < len(chunk):
+            # plain text is added up to the next control character in one step
+            if escape_code == '':
+                match = self.line_controls.search(chunk, i)
+                j = match.start() if match else len(chunk)
+                if j > i:
+                    line.append(chunk[i:j])
+                    echo.append(chunk[i:j])
+                    i = j
+                    continue
+
+            c = chunk[i]
+            i += 1
 
-                    line_pos -= 1
+            # process the escape code (but don't print it)
+            # ESC [ ... is ended by a character from @ to ~, other escapes are one character long
+            if escape_code != '':
+                escape_code += c
+                if escape_code == '\033[' or escape_code[:2] == '\033[' and '\040' <= c < '\100':
+                    continue # parameters of ESC [
+                self.escape_sequence(escape_code)
+                escape_code = ''
+                continue
 
             if c in '\n\r':
-                self.put(' ') # erase cursor
+                self._skip_lf = c == '\r'
+                if self._skip_lf and i < len(chunk) and chunk[i] == '\n':
+                    i += 1
+                    self._skip_lf = False
+                self._pending = chunk[i:]
+                done = True
                 break
             elif c in '\177\010': #DEL or BS
                 if len(line) > 0:
-                    line = line[:-1]
-                    line_pos -= 1
-                    self.put(' \010\010') # delete block, move cursor back
+                    line[-1] = line[-1][:-1]
+                    if line[-1] == '':
+                        line.pop()
+                    echo.append(' \010\010' + block + '\010') # delete block, move cursor back
             elif c == '\033':
-                escape_code += c
-                escape_seq = True
-            else:
-                self.put(c) # replace cursor with character
-                line_pos += 1
-                line += c
+                escape_code = c
 
-        return line
+        if self.echo:
+            # erase the cursor at the end of the line, otherwise move it after the chunk
+            echo.append(' ' if done else block + '\010')
+            self.put(''.join(echo))
+
+        return done, escape_code
+
+class Journal:
+    '''
+    append-only file which records  the expressions of a workspace. every time
+    an  expression is  bound, one  record  holding its  tree in  the axioms_2
+    binary format  is appended,  so keeping  the journal up  to date  is cheap.
+    snapshot() rewrites  the file with  just the current expressions  (and the
+    derivatives cached for them), and the appends that follow are its tail.
+
+    reading a  journal replays  the snapshot and  the tail from  a memory-map.
+    the trees  are  rebuilt from  their arrays,  so  no  expression  is parsed
+    again, and  the derivatives  are put  back into  derivative_cache.
+
+    file layout:
+        header: magic, version
+        record: kind, name length, variable length, data length, name,
+                variable, data
+    a bind record holds  the tree of name. a derivative record  holds the tree
+    of d(name)/d(variable) for the tree of the last bind record of name.
+    '''
+    magic = b'AXWS'
+    version = 1
+    header = struct.Struct('<4sH')
+    record = struct.Struct('<BHHI')
+
+    BIND = 1
+    DERIVATIVE = 2
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = None
+
+    def _pack(self, kind: int, name: str, var: str, data: bytes) -> bytes:
+        name = name.encode()
+        var = var.encode()
+        return self.record.pack(kind, len(name), len(var), len(data)) + name + var + data
+
+    def _derivatives(self, expression) -> list:
+        '''records of the derivatives of expression in derivative_cache'''
+        records = []
+        for var in expression.dir:
+            derivative = derivative_cache.get((expression.root, var))
+            if derivative != None:
+                records.append((var, ExpBase(root=derivative).to_bytes()))
+        return records
+
+    def open(self, end: int = None):
+        '''
+        opens the file for appending. end is the  size of the valid part of the
+        file (from read), anything after it is a record torn by a crash and is
+        dropped.
+        '''
+        self.file = open(self.path, 'r+b' if os.path.exists(self.path) else 'w+b')
+        if end != None:
+            self.file.truncate(end)
+        self.file.seek(0, os.SEEK_END)
+        if self.file.tell() == 0:
+            self.file.write(self.header.pack(self.magic, self.version))
+            self.file.flush()
+
+    def close(self):
+        if self.file != None:
+            self.file.close()
+            self.file = None
+
+    def append(self, name: str, expression):
+        '''appends a bind record of expression to the journal'''
+        if self.file == None:
+            self.open()
+
+        self.file.write(self._pack(self.BIND, name, '', expression.to_bytes()))
+        self.file.flush()
+
+    def snapshot(self, expressions: dict):
+        '''
+        replaces the journal with the current expressions. the snapshot is  written
+        to a temporary file first so that a crash never leaves a partial journal.
+        '''
+        self.close()
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(self.header.pack(self.magic, self.version))
+            for name, expression in expressions.items():
+                f.write(self._pack(self.BIND, name, '', expression.to_bytes()))
+                for var, data in self._derivatives(expression):
+                    f.write(self._pack(self.DERIVATIVE, name, var, data))
+        os.replace(tmp_path, self.path)
+
+        self.open()
+
+    def read(self, cls) -> (dict, int):
+        '''
+        replays the journal. returns the expressions (as instances of cls) and the
+        size  of  the  valid  part  of  the  file.  cached  derivatives  are  put
+        back into derivative_cache.
+        '''
+        expressions = {}
+        derivatives = {}
+
+        with open(self.path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return expressions, 0
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            if len(buffer) < self.header.size:
+                raise Exception(f'{self.path}: not a workspace journal')
+            magic, version = self.header.unpack_from(buffer, 0)
+            if magic != self.magic:
+                raise Exception(f'{self.path}: not a workspace journal')
+            if version != self.version:
+                raise Exception(f'{self.path}: unsupported journal version {version}')
+
+            offset = self.header.size
+            while offset + self.record.size <= len(buffer):
+                kind, name_len, var_len, data_len = self.record.unpack_from(buffer, offset)
+                start = offset + self.record.size
+                end = start + name_len + var_len + data_len
+                if end > len(buffer):
+                    break # torn record
+
+                name = buffer[start:start+name_len].decode()
+                var = buffer[start+name_len:start+name_len+var_len].decode()
+                tree = array_tree.from_bytes(memoryview(buffer)[start+name_len+var_len:end]).to_node()
+                if kind == self.BIND:
+                    expressions[name] = cls(root=tree)
+                    derivatives[name] = {}
+                elif kind == self.DERIVATIVE and name in derivatives:
+                    derivatives[name][var] = tree
+
+                offset = end
+        finally:
+            buffer.close()
+
+        for name, exp_derivatives in derivatives.items():
+            for var, tree in exp_derivatives.items():
+                derivative_cache.put((expressions[name].root, var), tree)
+
+        return expressions, offset
 
 class Process:
     """
@@ -277,6 +552,9 @@ class Process:
     def put(self, s: str):
         '''helper function to reduce typing'''
         self.state.put(s)
+    def error(self, s: str):
+        '''helper function to reduce typing'''
+        self.state.error(s)
     def get(self):
         '''helper function to reduce typing'''
         return self.state.get()
@@ -315,7 +593,7 @@ class cmd_line(Process):
                 self.state.putln()
                 self._run_cmd(line)
             except Exception as e:
-                self.state.putln('ERROR: there was a problem processing that command')
+                self.state.error('ERROR: there was a problem processing that command')
                 self.state.putln(str(e) + ', ' + str(type(e)))
 
     def _run_cmd(self, cmd: str):
@@ -366,58 +644,9 @@ class cmd_line(Process):
             Process.commands[argv[0]](argv, self.state).run()
             return
 
-        self.putln(f'command not found: "{argv[0]}"')
+        self.error(f'command not found: "{argv[0]}"')
         return
 
-
-    def getline(self):
-        '''
-        reads a line from the input  \'stream\'. Blocks until there is something
-        in the queue.
-
-        this functions performs  the line editing operations that  you would see
-        from a tty driver (ie backspace, echoing the character, etc.)
-        '''
-        block = '█'
-        line = ''
-
-        final_set = string.ascii_letters + '@[]\\^_`{}|~'
-        escape_seq = False
-        escape_code = ''
-
-        while True:
-            self.put(block + '\010')
-
-            # get and validate a character
-            c = self.istream.get()
-            if len(c) != 1:
-                raise LengthError
-
-            # process the escape code (but don't print it)
-            if escape_seq:
-                escape_code += c
-                if c in final_set:
-                    self.escape_sequence(escape_code)
-                    escape_code = ''
-                    escape_seq = False
-                continue
-
-            if c in '\n\r':
-                self.put(' ') # erase cursor
-                break
-            elif c in '\177\010': #DEL or BS
-                if len(line) > 0:
-                    line = line[:-1]
-                    self.put(' \010\010') # delete block, move cursor back
-            elif c == '\033':
-                escape_code += c
-                escape_seq = True
-            else:
-                self.put(c) # replace cursor with character
-                line += c
-
-        return line
-
 class _setexpr(Process):
     """
     This command supports colon syntax. use 'setexpr' when indexing this process
@@ -440,8 +669,9 @@ class _setexpr(Process):
         # ['setexpr', 'name', 'expression', ...]
         if len(argv) == 1:
             self.putln(self.help())
+            return
         elif len(argv) < 3:
-            self.putln('argument error: expected at least 2, got 1')
+            self.error('argument error: expected at least 2, got 1')
             return
 
         # remove any leading/trailing whitespace
@@ -450,7 +680,7 @@ class _setexpr(Process):
         forbidden_chars = '+=*&^%$#@!~`\|(){}[];:\'"/?.>,<`'
         for c in argv[1]:
             if c in forbidden_chars:
-                self.putln(f'invalid character errror: "{c}"')
+                self.error(f'invalid character errror: "{c}"')
                 return
 
         if argv[1] == '':
@@ -463,10 +693,10 @@ class _setexpr(Process):
         try:
             expression = Exp(exp_str)
         except Exception as e:
-            self.putln(f'expression format error: {e}')
+            self.error(f'expression format error: {e}')
             return
 
-        self.state.expressions[argv[1]] = expression
+        self.state.bind(argv[1], expression)
 
         eval_result = expression.evaluate()
         if eval_result != None:
@@ -490,6 +720,78 @@ class _list(Process):
 
         self.state.put(output)
 
+class _save(Process):
+    '''saves the workspace to a journal file'''
+    help_list = [
+        ('Description', \
+        '''\
+        writes all  the currently defined  expressions (and their  derivatives) to
+        FILE.  expressions which are defined after  this are appended to FILE as
+        they are defined. without FILE, the open journal is compacted.
+        '''),
+        ('Usage', 'save FILE')
+    ]
+
+    # argv[0]: save
+    # argv[1]: FILE
+    def run(self):
+        argv = self.argv
+        self.state.fg_proc = self.parent_process
+
+        if len(argv) == 1 and self.state.journal == None:
+            self.putln(self.help())
+            return
+
+        if len(argv) > 1:
+            if self.state.journal != None:
+                self.state.journal.close()
+            self.state.journal = Journal(argv[1])
+
+        try:
+            self.state.journal.snapshot(self.state.expressions)
+        except OSError as e:
+            self.state.journal = None
+            self.error(f'save error: {e}')
+            return
+
+        self.putln(f'    {len(self.state.expressions)} expressions -> {self.state.journal.path}')
+
+class _load(Process):
+    '''loads a workspace from a journal file'''
+    help_list = [
+        ('Description', \
+        '''\
+        defines the expressions saved in FILE (see save). expressions which are
+        defined after this are appended to FILE.
+        '''),
+        ('Usage', 'load FILE')
+    ]
+
+    # argv[0]: load
+    # argv[1]: FILE
+    def run(self):
+        argv = self.argv
+        self.state.fg_proc = self.parent_process
+
+        if len(argv) == 1:
+            self.putln(self.help())
+            return
+
+        journal = Journal(argv[1])
+        try:
+            expressions, end = journal.read(Exp)
+            journal.open(end)
+        except Exception as e:
+            self.error(f'load error: {e}')
+            return
+
+        if self.state.journal != None:
+            self.state.journal.close()
+        self.state.journal = journal
+        self.state.expressions.update(expressions)
+
+        self.putln(f'    {len(expressions)} expressions <- {journal.path}')
+
 class _help(Process):
     '''provides access to the robust help features of this application.'''
     help_list = [
@@ -519,7 +821,7 @@ class _help(Process):
             if argv[1] in self.commands:
                 self.putln(self.commands[argv[1]]([], self.state).help())
             else:
-                self.putln(f'the command "{argv[1]}" is not a valid command')
+                self.error(f'the command "{argv[1]}" is not a valid command')
 
         return
 
@@ -567,26 +869,29 @@ class _eval(Process):
 
         # TODO add the ability to parse an expression or expression reference
         if argv[1] not in self.state.expressions:
-            self.state.putln('    ERROR: expression "' + argv[1] + '" is not defined.')
+            self.state.error('    ERROR: expression "' + argv[1] + '" is not defined.')
             return
 
         exp = self.state.expressions[argv[1]]
+        root = exp.root
 
         try:
             exp.evaluate_funcs(env=self.state.expressions)
         except Exception as e:
-            self.putln(f'error during evaluation: {e}')
+            self.error(f'error during evaluation: {e}')
             return
 
-        # XXX probably don't need to fix the variables twice.
-        # fix the variables
-        exp.dir.clear()
-        exp.map()
+        # nodes are interned, so the tree changed only if the root is another node.
+        # only a change is bound again, so evaluating doesn't grow the journal
+        if exp.root is not root:
+            self.state.bind(argv[1], exp)
+
+        # the index of the variables (exp.dir) is rebuilt by the expression when its root changes
 
         try:
             eval_result = exp.evaluate()
         except Exception as e:
-            self.putln(f'error during evaluation: {e}')
+            self.error(f'error during evaluation: {e}')
             return
 
         if eval_result != None:
@@ -639,7 +944,7 @@ class _mathilda(Process):
             _mathilda.assistant.add_context(self.get_context(), 'default')
             convo = _mathilda.assistant
         else:
-            self.putln('argument error: unrecognized arguments')
+            self.error('argument error: unrecognized arguments')
 
         while True:
             self.put('mathilda> ')
@@ -661,6 +966,8 @@ class _mathilda(Process):
 
 Process.register(_setexpr)
 Process.register(_list)
+Process.register(_save)
+Process.register(_load)
 Process.register(_help)
 Process.register(_exit)
 Process.register(_echo)
@@ -697,11 +1004,14 @@ class Exp(ExpBase):
     looks for arbitrary functions in the expression tree.
 
     if a match is found, it is evaluated, and its result is
-    spliced into the tree.
+    spliced into the tree. nodes are immutable, so the tree is rebuilt
+    around the spliced results and the new root is returned. when called
+    without a root, self.root is updated.
     '''
     def evaluate_funcs(self, root=None, env:dict=None):
         if root == None:
-            root = self.root
+            self.root = self.evaluate_funcs(self.root, env)
+            return self.root
 
         if root.val in Exp.funcs:
             # the arguments for the arbitrary function are a list of the parameters (split by comma)
@@ -710,22 +1020,19 @@ class Exp(ExpBase):
             expr = Exp.funcs[root.val](argv, env)
 
             # splice in the root of the new expression at this node.
-            root.val = expr.root.val
-            root.left = expr.root.left
-            root.right = expr.root.right # we can forget about the function arguments
+            # we can forget about the function arguments
+            root = expr.root
 
-            # the new expression that was spliced in may have arbitrary functions
-            # as well. better evaluate_funcs() on them too.
-            if root.left != None:
-                self.evaluate_funcs(root.left, env)
-            if root.right != None:
-                self.evaluate_funcs(root.right, env)
+        # the new expression that was spliced in may have arbitrary functions
+        # as well. better evaluate_funcs() on them too.
+        left = root.left
+        right = root.right
+        if left != None:
+            left = self.evaluate_funcs(left, env)
+        if right != None:
+            right = self.evaluate_funcs(right, env)
 
-        else:
-            if root.left != None:
-                self.evaluate_funcs(root.left, env)
-            if root.right != None:
-                self.evaluate_funcs(root.right, env)
+        return node(root.val, left, right)
 
 
     # argv[0]: EXPRESSION (from CLI namespace)
@@ -757,3 +1064,242 @@ class Exp(ExpBase):
         'pd': _evaluate_pd,
         'dummy': lambda : NotImplemented
     }
+
+################################################
+class BatchState(State):
+    '''
+    State for running  a script of commands without a  terminal (see run_batch).
+    lines are read from script instead of istream, and the output is written to
+    out as plain text (no CR LF translation, no echo).
+    '''
+    def __init__(self, script, out=sys.stdout):
+        super().__init__()
+        self.script = iter(script)
+        self.out = out
+        self.echo = False
+
+    def put(self, s):
+        if isinstance(s, (bytes, bytearray, memoryview)):
+            s = self._decoder.decode(bytes(s))
+
+        self.out.write(s)
+
+    def getline(self):
+        '''returns the next line of the script. raises EOFError at the end of the script'''
+        line = next(self.script, None)
+        if line == None:
+            raise EOFError
+
+        return line.rstrip('\r\n')
+
+def run_batch(script, out=sys.stdout, stop_on_error=False, timing=False, state=None) -> int:
+    '''
+    runs  the commands in script  (any iterable of  lines, ie. an open file)
+    through cmd_line  and  writes  their output to out. blank lines and lines
+    starting with \'#\' are skipped.
+
+    stop_on_error: stop at the first command which reports an error
+    timing: write the time each command took to stderr
+    state: BatchState to run the commands in (ie. to keep the expressions of an
+           earlier run), a new one is created by default
+
+    returns the number of errors.
+    '''
+    if state == None:
+        state = BatchState(script, out)
+    else:
+        state.script = iter(script)
+        state.out = out
+
+    shell = state.fg_proc
+    errors = state.errors
+    while not state.exit_prog:
+        try:
+            line = state.getline()
+        except EOFError:
+            break
+
+        if line.strip() == '' or line.lstrip().startswith('#'):
+            continue
+
+        start = time.perf_counter()
+        try:
+            shell._run_cmd(line)
+        except Exception as e:
+            state.error(f'ERROR: {line}')
+            state.putln(str(e) + ', ' + str(type(e)))
+
+        if timing:
+            sys.stderr.write(f'{(time.perf_counter()-start)*1000:10.3f} ms  {line}\n')
+
+        if stop_on_error and state.errors > errors:
+            break
+
+    out.flush()
+    return state.errors - errors
+
+################################################
+class AsyncState(State):
+    '''
+    State for  running a session  in an asyncio event  loop. istream is  an
+    asyncio.Queue, and the  session  is a  coroutine  (see  async_cmd_line)
+    which waits on it, so an idle session holds no thread. the front end sends
+    input with send() and waits for output with read().
+
+    get and getline are coroutines in the event loop. commands which take long
+    (see async_cmd_line.executor_commands)  are  run  in  an  executor,  there
+    get and getline block the worker thread until the input arrives, so these
+    commands work without changes.
+    '''
+    def __init__(self, executor=None):
+        super().__init__()
+        self.istream = asyncio.Queue()
+        self.fg_proc = async_cmd_line([], self)
+
+        self.executor = executor # None uses the default executor of the loop
+        self.loop = None # set when the session starts running
+        self._output_ready = asyncio.Event()
+
+    def _in_loop(self) -> bool:
+        '''True when called from the thread running the event loop of the session'''
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def put(self, s):
+        super().put(s)
+
+        # wake up read(), the loop has to do it when put is called from an executor
+        if self.loop == None or self._in_loop():
+            self._output_ready.set()
+        else:
+            self.loop.call_soon_threadsafe(self._output_ready.set)
+
+    def send(self, s: str):
+        '''sends input to the session. must be called from the event loop'''
+        self.istream.put_nowait(s)
+
+    async def read(self) -> str:
+        '''waits until there is output and returns all of it'''
+        while True:
+            self._output_ready.clear()
+            if not self.ostream.empty():
+                return self.ostream.drain()
+            await self._output_ready.wait()
+
+    async def _chunk_async(self) -> str:
+        '''like _chunk, but waits for the input without blocking the loop'''
+        chunk = self._pending
+        self._pending = ''
+        while chunk == '':
+            chunk = await self.istream.get()
+            if len(chunk) == 0:
+                raise LengthError
+        return chunk
+
+    async def _get(self):
+        chunk = await self._chunk_async()
+        self._pending = chunk[1:]
+        return chunk[0]
+
+    async def _getline(self):
+        line = []
+        done = False
+        escape_code = ''
+
+        if self.echo:
+            self.put(self.block + '\010')
+
+        while not done:
+            done, escape_code = self._edit(line, await self._chunk_async(), escape_code)
+
+        return ''.join(line)
+
+    def get(self):
+        '''
+        reads a character (see State.get). in the event loop this returns a
+        coroutine, in an executor it waits for the character.
+        '''
+        if self._in_loop():
+            return self._get()
+        return asyncio.run_coroutine_threadsafe(self._get(), self.loop).result()
+
+    def getline(self):
+        '''
+        reads a line (see State.getline). in the event loop this returns a
+        coroutine, in an executor it waits for the line.
+        '''
+        if self._in_loop():
+            return self._getline()
+        return asyncio.run_coroutine_threadsafe(self._getline(), self.loop).result()
+
+    async def run(self):
+        '''runs the session until the exit command'''
+        self.loop = asyncio.get_running_loop()
+        await self.fg_proc.run()
+
+class async_cmd_line(cmd_line):
+    '''
+    cmd_line for an AsyncState. commands in executor_commands (and the colon
+    syntax)  run in the  executor of the state, the  others are quick  and run
+    in the event loop.
+    '''
+    executor_commands = {'setexpr', 'eval', 'save', 'load', 'mathilda', 'command'}
+
+    async def run(self):
+        intro_text = '''\
+        CALCULATOR RUNTIME ENVIRONMENT
+        Written by Ethan Smith and Erik Huuki
+        for a list of available commands, type 'help'
+        '''
+
+        self.state.put(dedent(intro_text))
+        self.state.putln()
+
+        while not self.state.exit_prog:
+            # print prompt
+            self.state.put('> ')
+
+            # get user input
+            try:
+                line = await self.state.getline()
+            except Exception as e:
+                self.state.put(f'Input Error: {str(e)}')
+                continue
+
+            if line != '':
+                self.state.push_cmd(line)
+
+            try:
+                self.state.putln()
+                await self.run_cmd(line)
+            except Exception as e:
+                self.state.error('ERROR: there was a problem processing that command')
+                self.state.putln(str(e) + ', ' + str(type(e)))
+
+    async def run_cmd(self, cmd: str):
+        '''runs cmd with _run_cmd, in the executor if it can take long'''
+        argv = cmd.split()
+        if len(argv) > 0 and argv[0] in Process.commands and argv[0] not in self.executor_commands:
+            self._run_cmd(cmd)
+            return
+
+        await self.state.loop.run_in_executor(self.state.executor, self._run_cmd, cmd)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='runs a script of calculator commands without a terminal')
+    parser.add_argument('script', nargs='?', help='file with one command per line (default: stdin)')
+    parser.add_argument('-o', '--output', help='file to write the output to (default: stdout)')
+    parser.add_argument('-e', '--stop-on-error', action='store_true', help='stop with exit status 1 at the first error')
+    parser.add_argument('-t', '--time', action='store_true', help='write the time each command took to stderr')
+    args = parser.parse_args()
+
+    script = open(args.script) if args.script else sys.stdin
+    out = open(args.output, 'w') if args.output else sys.stdout
+
+    errors = run_batch(script, out, args.stop_on_error, args.time)
+
+    if args.output:
+        out.close()
+    sys.exit(1 if errors and args.stop_on_error else 0)
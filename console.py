@@ -121,7 +121,7 @@ class Terminal(QtWidgets.QScrollArea):
 
     soon it will support even more dumb terminal things, like a cursor.
     '''
-    def __init__(self, parent, istream: Queue, ostream: Queue):
+    def __init__(self, parent, istream: Queue, ostream: command_line.OutputStream):
         super().__init__(parent)
         self.setWidgetResizable(True)
 
@@ -201,13 +201,10 @@ class Terminal(QtWidgets.QScrollArea):
         self.refresh_text()
 
     def recv_text(self):
-        while True:
-            try:
-                c = self.ostream.get_nowait()
-
-                self.write(c)
-            except Empty:
-                break
+        # everything the interpreter has written since the last call
+        txt = self.ostream.drain()
+        if txt != '':
+            self.write(txt)
 
         # scroll output view to bottom if necessary
         # BUG the scroll view isn't getting updated for some reason.
@@ -215,12 +212,11 @@ class Terminal(QtWidgets.QScrollArea):
         scrollbar.setValue(scrollbar.maximum())
 
     def tx(self, s: str):
-        for c in s:
-            self.istream.put(c)
+        # the interpreter reads whole chunks, so s is sent at once
+        self.istream.put(s)
 
     def exit(self):
-        for c in 'exit\n':
-            self.istream.put(c)
+        self.istream.put('exit\n')
 
 class MainWindow(QtWidgets.QMainWindow):
     def __init__(self):
@@ -303,6 +299,7 @@ list of valid commands:
     - set_expression Name EXPRESSION
         - Name: Expression (set_expression colon operator)
     - load FILE
+    - save FILE
     - eval EXPRESSION
     - clear
     - del EXPRESSION
@@ -0,0 +1,324 @@
+#!/usr/bin/env python3.8
+'''
+hosts calculator sessions (see command_line.AsyncState) for many clients  in
+one process. every connection to the server gets its own session, while  the
+parse and derivative caches of axioms_2 and the worker pool are shared by all
+of them, so a client doesn't pay for starting the runtime or for  working out
+what another client already has.
+
+the server listens on a unix socket or on a tcp port. messages are sent in
+frames instead of a raw stream of characters:
+
+    length (4 bytes, big endian) | kind (1 byte) | payload (length bytes)
+
+client to server:
+    I: input for the session (utf-8 text, any number of lines)
+    S: asks for the statistics of the session
+    Q: closes the session
+
+server to client:
+    O: output of the session (utf-8 text)
+    S: statistics of the session and the server (json, see Server.stats)
+    X: the session is closed, the payload is the reason ('exit', 'quit',
+       'session error: ...' when the session crashed, ...)
+
+Client is a small client for scripts and tests.
+'''
+from command_line import AsyncState
+from axioms_2 import parse_cache, derivative_cache
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import argparse
+import struct
+import json
+import sys
+
+frame_header = struct.Struct('>IB')
+
+INPUT = ord('I')
+OUTPUT = ord('O')
+STATS = ord('S')
+QUIT = ord('Q')
+CLOSED = ord('X')
+
+class ProtocolError(Exception):
+    '''raised when a peer sends something which is not a frame'''
+    pass
+
+def pack_frame(kind: int, payload: bytes = b'') -> bytes:
+    return frame_header.pack(len(payload), kind) + payload
+
+async def read_frame(reader, max_size: int = 1 << 24) -> (int, bytes):
+    '''
+    reads one frame. returns (kind, payload), or (None, b'') when the peer
+    closed the connection between frames.
+    '''
+    try:
+        header = await reader.readexactly(frame_header.size)
+    except asyncio.IncompleteReadError as e:
+        if len(e.partial) == 0:
+            return None, b''
+        raise ProtocolError('connection closed inside a frame header')
+
+    size, kind = frame_header.unpack(header)
+    if size > max_size:
+        raise ProtocolError(f'frame of {size} bytes is larger than {max_size}')
+
+    try:
+        payload = await reader.readexactly(size)
+    except asyncio.IncompleteReadError:
+        raise ProtocolError('connection closed inside a frame')
+
+    return kind, payload
+
+def session_memory(state) -> dict:
+    '''
+    approximate memory held by a session in bytes. nodes are counted once per
+    session even when they are shared with other sessions (nodes are interned).
+    history_bytes is the command history of the session, output_bytes is the
+    number of characters waiting to be sent.
+    '''
+    seen = set()
+    stack = [e.root for e in state.expressions.values()]
+    node_bytes = 0
+    while stack:
+        a = stack.pop()
+        if a is None or id(a) in seen:
+            continue
+        seen.add(id(a))
+        node_bytes += sys.getsizeof(a) + sys.getsizeof(a.val)
+        stack.append(a.left)
+        stack.append(a.right)
+
+    expression_bytes = sum(sys.getsizeof(name) + sys.getsizeof(e) for name, e in state.expressions.items())
+    history_bytes = sum(sys.getsizeof(cmd) for cmd in state.command_history)
+    output_bytes = len(state.ostream)
+
+    return {
+        'expressions': len(state.expressions),
+        'nodes': len(seen),
+        'node_bytes': node_bytes,
+        'expression_bytes': expression_bytes,
+        'history_bytes': history_bytes,
+        'output_bytes': output_bytes,
+        'total_bytes': node_bytes + expression_bytes + history_bytes + output_bytes
+    }
+
+class Server:
+    '''
+    serves one AsyncState session per connection.
+
+    max_sessions: connections over this number are closed with an X frame
+    workers: number of threads which run the commands of all the sessions
+    '''
+    def __init__(self, max_sessions: int = 64, workers: int = 4):
+        self.max_sessions = max_sessions
+        self.executor = ThreadPoolExecutor(workers)
+        self.sessions = {} # id -> AsyncState
+        self.next_id = 0
+        self.server = None
+
+    async def start_unix(self, path: str):
+        self.server = await asyncio.start_unix_server(self._serve, path)
+        return self.server
+
+    async def start_tcp(self, host: str = '127.0.0.1', port: int = 0):
+        '''listens on host:port (port 0 picks a free port, see address())'''
+        self.server = await asyncio.start_server(self._serve, host, port)
+        return self.server
+
+    def address(self):
+        return self.server.sockets[0].getsockname()
+
+    async def close(self):
+        if self.server != None:
+            self.server.close()
+            await self.server.wait_closed()
+        self.executor.shutdown(wait=False)
+
+    def stats(self, session_id: int = None) -> dict:
+        '''statistics of the server, and of the session session_id'''
+        stats = {
+            'sessions': len(self.sessions),
+            'max_sessions': self.max_sessions,
+            'parse_cache': parse_cache.info(),
+            'derivative_cache': derivative_cache.info()
+        }
+        if session_id in self.sessions:
+            stats['session'] = session_id
+            stats['memory'] = session_memory(self.sessions[session_id])
+        return stats
+
+    async def _serve(self, reader, writer):
+        '''runs a session for one connection'''
+        if len(self.sessions) >= self.max_sessions:
+            writer.write(pack_frame(CLOSED, b'session limit reached'))
+            await writer.drain()
+            writer.close()
+            return
+
+        session_id = self.next_id
+        self.next_id += 1
+
+        state = AsyncState(self.executor)
+        state.echo = False # clients get their input back from the frames they sent
+        self.sessions[session_id] = state
+
+        session = asyncio.create_task(state.run())
+        output = asyncio.create_task(self._send_output(state, writer))
+        inputs = asyncio.create_task(self._recv_input(state, session_id, reader, writer))
+        reason = 'exit'
+        try:
+            await asyncio.wait([session, inputs, output], return_when=asyncio.FIRST_COMPLETED)
+            if session.done() and session.exception() != None:
+                reason = f'session error: {session.exception()!r}'
+            elif inputs.done():
+                reason = inputs.result()
+            elif output.done():
+                reason = str(output.exception())
+        except (ProtocolError, ConnectionError) as e:
+            reason = str(e)
+        finally:
+            for task in (session, inputs, output):
+                task.cancel()
+            del self.sessions[session_id]
+
+        # whatever the session printed before it ended
+        try:
+            remaining = state.ostream.drain()
+            if remaining != '':
+                writer.write(pack_frame(OUTPUT, remaining.encode()))
+            writer.write(pack_frame(CLOSED, reason.encode()))
+            await writer.drain()
+            writer.close()
+        except ConnectionError:
+            pass
+
+    async def _recv_input(self, state, session_id: int, reader, writer) -> str:
+        '''forwards input frames to the session. returns why the connection ended'''
+        while True:
+            try:
+                kind, payload = await read_frame(reader)
+            except (ProtocolError, ConnectionError) as e:
+                return str(e)
+
+            if kind == None:
+                return 'client closed the connection'
+            elif kind == INPUT:
+                state.send(payload.decode(errors='replace'))
+            elif kind == STATS:
+                writer.write(pack_frame(STATS, json.dumps(self.stats(session_id)).encode()))
+                await writer.drain()
+            elif kind == QUIT:
+                return 'quit'
+            else:
+                return f'unknown frame kind {kind}'
+
+    async def _send_output(self, state, writer):
+        '''sends the output of the session as it is written'''
+        while True:
+            text = await state.read()
+            writer.write(pack_frame(OUTPUT, text.encode()))
+            await writer.drain()
+
+class Client:
+    '''
+    client of a Server. run() sends one command and returns its output, which
+    is what a script or a test usually needs.
+    '''
+    prompt = '> '
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.output = '' # output which was received but not returned yet
+        self.closed = None # reason the server gave for closing the session
+        self.ready = False # the last output which was returned ended at a prompt
+
+    @classmethod
+    async def connect_unix(cls, path: str):
+        return cls(*await asyncio.open_unix_connection(path))
+
+    @classmethod
+    async def connect_tcp(cls, host: str, port: int):
+        return cls(*await asyncio.open_connection(host, port))
+
+    async def send(self, text: str):
+        self.writer.write(pack_frame(INPUT, text.encode()))
+        await self.writer.drain()
+
+    async def _recv(self) -> (int, bytes):
+        '''next frame which is not output, output is added to self.output'''
+        while True:
+            kind, payload = await read_frame(self.reader)
+            if kind == OUTPUT:
+                self.output += payload.decode()
+                if self.output.endswith(self.prompt):
+                    return OUTPUT, b''
+            elif kind == None:
+                self.closed = self.closed or 'connection closed'
+                return CLOSED, b''
+            else:
+                if kind == CLOSED:
+                    self.closed = payload.decode()
+                return kind, payload
+
+    async def read_until_prompt(self) -> str:
+        '''output up to the next prompt (or up to the end of the session)'''
+        while not self.output.endswith(self.prompt) and self.closed == None:
+            await self._recv()
+
+        output = self.output
+        self.output = ''
+        self.ready = output.endswith(self.prompt)
+        if self.ready:
+            output = output[:-len(self.prompt)]
+        return output
+
+    async def run(self, cmd: str) -> str:
+        '''runs a command and returns its output'''
+        if not self.ready:
+            await self.read_until_prompt()
+        await self.send(cmd + '\n')
+        self.ready = False
+        return await self.read_until_prompt()
+
+    async def stats(self) -> dict:
+        self.writer.write(pack_frame(STATS))
+        await self.writer.drain()
+        while True:
+            kind, payload = await self._recv()
+            if kind == STATS:
+                return json.loads(payload)
+            if kind == CLOSED:
+                raise ConnectionError(f'session closed: {self.closed}')
+
+    async def close(self):
+        if self.closed == None:
+            self.writer.write(pack_frame(QUIT))
+            await self.writer.drain()
+            while self.closed == None:
+                await self._recv()
+        self.writer.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='serves calculator sessions over a socket')
+    parser.add_argument('--unix', help='path of the unix socket to listen on')
+    parser.add_argument('--host', default='127.0.0.1', help='host to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=7722, help='tcp port to listen on (default: 7722)')
+    parser.add_argument('--max-sessions', type=int, default=64, help='most sessions at once (default: 64)')
+    parser.add_argument('--workers', type=int, default=4, help='threads which run commands (default: 4)')
+    args = parser.parse_args()
+
+    async def main():
+        server = Server(args.max_sessions, args.workers)
+        if args.unix:
+            await server.start_unix(args.unix)
+        else:
+            await server.start_tcp(args.host, args.port)
+        print(f'listening on {server.address()}')
+
+        async with server.server:
+            await server.server.serve_forever()
+
+    asyncio.run(main())